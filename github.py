@@ -1,30 +1,117 @@
 import tempfile
-from typing import Dict
+from typing import Iterator, List, Optional, Tuple
 import shutil
 import os
 import git
 import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Extensions of files that are never text, skipped without being opened
+BINARY_EXTENSIONS = frozenset({
+    '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.ico', '.webp', '.pdf',
+    '.zip', '.tar', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.jar', '.war',
+    '.woff', '.woff2', '.ttf', '.otf', '.eot', '.mp3', '.mp4', '.mov', '.avi', '.wav',
+    '.so', '.dll', '.dylib', '.exe', '.bin', '.o', '.a', '.class', '.pyc', '.pyo', '.wasm'
+})
+
+# Number of leading bytes checked for NUL when deciding whether a file is binary
+BINARY_SNIFF_SIZE = 8192
+
+def iter_repo_files(clone_dir) -> Iterator[Tuple[str, str]]:
+    """Lazily yield (relative path, content) for each text file in a cloned repository, excluding generated wraith.docs output"""
+    for root, dirs, files in os.walk(clone_dir):
+        if '.git' in dirs:
+            dirs.remove('.git')
+        if root == clone_dir and 'wraith.docs' in dirs:
+            dirs.remove('wraith.docs')
+        for file in files:
+            if os.path.splitext(file)[-1].lower() in BINARY_EXTENSIONS:
+                continue
+
+            abs_path = os.path.join(root, file)
+            with open(abs_path, 'rb') as f:
+                head = f.read(BINARY_SNIFF_SIZE)
+                if b'\x00' in head:
+                    continue
+                content = (head + f.read()).decode('utf-8', errors='replace')
+
+            yield os.path.relpath(abs_path, clone_dir), content
+
+def sparse_patterns(extensions: List[str]) -> List[str]:
+    """Sparse-checkout patterns selecting files with the given extensions, plus .gitignore"""
+    return [f"*{ext}" for ext in extensions] + ['.gitignore']
+
+def update_repo(github_url, clone_dir, extensions: Optional[List[str]] = None) -> bool:
+    """
+    Bring an existing clone of github_url in clone_dir up to date in place.
+
+    Fetches only the new tip commit, hard-resets the working tree onto it and removes untracked
+    files other than wraith.docs. Returns False when there is no usable clone of the same URL,
+    in which case the caller should clone from scratch.
+    """
+    if not os.path.isdir(os.path.join(clone_dir, '.git')):
+        return False
+
+    try:
+        repo = git.Repo(clone_dir)
+        if repo.remotes.origin.url != github_url:
+            return False
+
+        logger.info("Updating existing clone of %s...", github_url)
+        repo.remotes.origin.fetch(depth=1)
+        repo.git.reset('--hard', 'FETCH_HEAD')
+        if extensions:
+            repo.git.sparse_checkout('set', '--no-cone', *sparse_patterns(extensions))
+        else:
+            repo.git.sparse_checkout('disable')
+        repo.git.clean('-fdx', '-e', 'wraith.docs')
+        return True
+    except Exception as e:
+        logger.warning("Failed to update existing clone, re-cloning: %s", e)
+        return False
+
+def get_repo(github_url, clone_dir="./.git_wraith_repo", extensions: Optional[List[str]] = None) -> Iterator[Tuple[str, str]]:
+    """
+    Clone github_url into clone_dir, preserving any existing wraith.docs output.
+
+    The clone happens immediately; file contents are returned as a lazy iterator so only one
+    file is held in memory at a time. Use dict(get_repo(...)) where a mapping is needed.
+
+    If extensions is given, the clone is a blobless partial clone with a sparse checkout of
+    matching files (plus .gitignore), so only the blobs that will be documented are downloaded.
+
+    An existing clone of the same URL is updated in place rather than downloaded again.
+    """
+    if update_repo(github_url, clone_dir, extensions):
+        return iter_repo_files(clone_dir)
 
-def get_repo(github_url, clone_dir="./.git_wraith_repo") -> Dict[str, str]:
     # Backup the wraith.docs folder if it exists
     wraith_docs_path = os.path.join(clone_dir, "wraith.docs")
     temp_wraith_path = None
 
     if os.path.exists(wraith_docs_path):
         temp_wraith_path = tempfile.mkdtemp()
-        print(f"Preserving 'wraith.docs' to {temp_wraith_path}")
+        logger.info("Preserving 'wraith.docs' to %s", temp_wraith_path)
         shutil.move(wraith_docs_path, os.path.join(temp_wraith_path, "wraith.docs"))
 
     # Clear and recreate the clone directory
     if os.path.exists(clone_dir):
-        print(f"Clearing directory {clone_dir}...")
+        logger.info("Clearing directory %s...", clone_dir)
         shutil.rmtree(clone_dir)
     os.makedirs(clone_dir)
 
-    # Clone the repository
+    # Clone the repository. Only the current tree is ever read, so skip the history and tags.
     try:
-        print(f"Cloning repository from {github_url}...")
-        repo = git.Repo.clone_from(github_url, clone_dir)
+        logger.info("Cloning repository from %s...", github_url)
+        if extensions:
+            repo = git.Repo.clone_from(github_url, clone_dir, depth=1, single_branch=True, no_tags=True,
+                                       multi_options=['--filter=blob:none', '--no-checkout'])
+            repo.git.sparse_checkout('set', '--no-cone', *sparse_patterns(extensions))
+            repo.git.checkout()
+        else:
+            repo = git.Repo.clone_from(github_url, clone_dir, depth=1, single_branch=True, no_tags=True)
     except Exception as e:
         raise ValueError(f"Failed to clone repository: {str(e)}")
 
@@ -32,16 +119,10 @@ def get_repo(github_url, clone_dir="./.git_wraith_repo") -> Dict[str, str]:
     if temp_wraith_path:
         try:
             shutil.move(os.path.join(temp_wraith_path, "wraith.docs"), wraith_docs_path)
-            print("Restored 'wraith.docs' to repo directory.")
+            logger.info("Restored 'wraith.docs' to repo directory.")
             shutil.rmtree(temp_wraith_path)
         except Exception as e:
-            print(f"Warning: Failed to restore 'wraith.docs': {e}")
+            logger.warning("Failed to restore 'wraith.docs': %s", e)
 
-    # Read file contents
-    file_contents = {}
-    for root, dirs, files in os.walk(clone_dir):
-        for file in files:
-            abs_path = os.path.join(root, file)
-            rel_path = os.path.relpath(abs_path, clone_dir)
+    return iter_repo_files(clone_dir)
 
-    return file_contents
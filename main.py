@@ -4,12 +4,9 @@ import sys
 import boto3
 import argparse
 import re
-from tree_sitter import Node
-from tree_sitter_languages import get_parser, get_language
 from pathspec import GitIgnoreSpec
 from typing import Dict, List, Optional
 import json
-import traceback
 import hashlib
 import bottle
 from server import *
@@ -18,11 +15,30 @@ import time
 from tqdm import tqdm
 import random
 from botocore.exceptions import ClientError
-import math
+from botocore.config import Config
+import mmap
+import stat
 import subprocess
 import tempfile
+import threading
+import logging
+import functools
+import bisect
+import itertools
+import xxhash
+import orjson
 import os
 
+logger = logging.getLogger(__name__)
+
+class TqdmLoggingHandler(logging.Handler):
+    """Logging handler that writes through tqdm so log lines don't break the progress bar"""
+    def emit(self, record):
+        try:
+            tqdm.write(self.format(record))
+        except Exception:
+            self.handleError(record)
+
 def validate_mermaid(mermaid_code: str) -> bool:
     with tempfile.NamedTemporaryFile(mode='w', suffix='.mmd', delete=False) as f:
         f.write(mermaid_code)
@@ -35,17 +51,31 @@ def validate_mermaid(mermaid_code: str) -> bool:
             ["npx", "mmdc", "-i", temp_path, "-o", outputFile],
             check=True,
             stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
+            stderr=subprocess.PIPE
         )
         return True
     except subprocess.CalledProcessError as e:
-        print("Mermaid syntax error:\n", e.stderr.decode())
+        logger.debug("Mermaid syntax error:\n%s", e.stderr.decode(errors='replace'))
         return False
     finally:
         os.remove(temp_path)
 
-# Initialize Bedrock client for AI model access
-bedrock = boto3.client('bedrock-runtime', region_name='eu-west-2')
+# Minimum size of the Bedrock client's connection pool; botocore's default is 10
+BEDROCK_POOL_CONNECTIONS = 64
+
+# Bedrock client for AI model access, created on first use so runs that never call Bedrock (the
+# server, unchanged repositories) skip loading the service model. One client is shared by all
+# worker threads, so its connection pool is never smaller than the in-flight request limit;
+# otherwise excess connections are discarded and re-established with a new TLS handshake.
+# Long generations can take minutes, beyond the default 60s read timeout.
+@functools.lru_cache(maxsize=1)
+def get_bedrock():
+    return boto3.client('bedrock-runtime', region_name='eu-west-2', config=Config(
+        max_pool_connections=max(BEDROCK_POOL_CONNECTIONS, bedrock_limit),
+        connect_timeout=5,
+        read_timeout=300,
+        tcp_keepalive=True
+    ))
 
 # Configuration for different programming languages
 # Each language specifies:
@@ -115,98 +145,237 @@ LANGUAGE_CONFIG = {
     }
 }
 
-def compute_file_hash(filepath, algorithm='sha256', max_size=10 * 1024 * 1024, sample_size=64 * 1024):
+# Default file-change hash. Cache keys need no cryptographic strength, and xxh3 is many times
+# faster than SHA-256; 128 bits keeps collisions negligible for duplicate detection.
+DEFAULT_HASH_ALGORITHM = 'xxh3_128'
+
+# Non-cryptographic hashes provided by xxhash rather than hashlib
+XXHASH_ALGORITHMS = {
+    'xxh3_64': xxhash.xxh3_64,
+    'xxh3_128': xxhash.xxh3_128,
+}
+
+# Files up to this size are hashed from a single read; mapping them costs more than copying
+MMAP_MIN_SIZE = 1024 * 1024
+
+def hasher_factory(algorithm=DEFAULT_HASH_ALGORITHM):
+    """
+    Resolve a hash algorithm name to its constructor once, so hashing many files does not look
+    the name up again for each one.
+
+    Raises ValueError if the algorithm is neither an xxhash nor a hashlib algorithm.
+    """
+    if algorithm in XXHASH_ALGORITHMS:
+        return XXHASH_ALGORITHMS[algorithm]
+    if algorithm in hashlib.algorithms_guaranteed and hasattr(hashlib, algorithm):
+        return getattr(hashlib, algorithm)
+    if algorithm in hashlib.algorithms_available:
+        return functools.partial(hashlib.new, algorithm)
+    raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+
+def compute_file_hash(filepath, algorithm=DEFAULT_HASH_ALGORITHM, factory=None, file_size=None):
     """
-    Computes the hash of a file. If the file is larger than max_size,
-    only a sample from the beginning and end of the file is used.
+    Computes the hash of a file's entire content.
+
+    Most files are read in one call; larger ones are mapped, with sequential readahead where
+    supported, so the hash reads them straight from the page cache in one update. Filesystems
+    that cannot map files fall back to reading in chunks.
 
     Args:
         filepath (str): Path to the file.
-        algorithm (str): Hash algorithm (default 'sha256').
-        max_size (int): Threshold size (in bytes) above which only a sample is hashed.
-        sample_size (int): Number of bytes to read from start and end for large files.
+        algorithm (str): Hash algorithm, an xxhash name or any hashlib name (default 'xxh3_128').
+        factory (callable): Constructor from hasher_factory; when given, algorithm is ignored.
+        file_size (int): Size of the file if the caller has already stat'ed it; otherwise the
+            open file is fstat'ed. It only selects how the file is read.
 
     Returns:
         str: Hexadecimal digest of the hash.
     """
-    try:
-        hasher = hashlib.new(algorithm)
-    except ValueError:
-        raise ValueError(f"Unsupported hash algorithm: {algorithm}")
-
-    file_size = os.path.getsize(filepath)
+    hasher = (factory or hasher_factory(algorithm))()
 
     with open(filepath, 'rb') as f:
-        # For small files, hash the entire content.
-        if file_size <= max_size:
-            while True:
-                chunk = f.read(4096)
-                if not chunk:
-                    break
-                hasher.update(chunk)
+        if file_size is None:
+            file_size = os.fstat(f.fileno()).st_size
+        if file_size <= MMAP_MIN_SIZE:
+            hasher.update(f.read())
         else:
-            # For large files, hash only a sample: beginning, file size, and end.
-            # Read beginning
-            beginning = f.read(sample_size)
-            hasher.update(beginning)
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    # The hash reads the map front to back once; widen the kernel's readahead
+                    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    hasher.update(mm)
+            except (OSError, ValueError):
+                f.seek(0)
+                for chunk in iter(lambda: f.read(MMAP_MIN_SIZE), b''):
+                    hasher.update(chunk)
 
-            # Include the file size to help differentiate files with similar samples.
-            hasher.update(str(file_size).encode('utf-8'))
+    return hasher.hexdigest()
 
-            # Read end sample: seek to the last sample_size bytes
-            if file_size > sample_size:
-                f.seek(-sample_size, os.SEEK_END)
-                end_sample = f.read(sample_size)
-                hasher.update(end_sample)
+# Summaries are kept beside the hash cache in an append-only JSON Lines file, so a run writes
+# only the summaries that changed. The last record for a path wins; a null summary deletes it.
+SUMMARIES_FILE = '.wraith.summaries.jsonl'
 
-    return hasher.hexdigest()
+# The summaries file is compacted once it holds more than this many records per live summary
+SUMMARIES_COMPACT_RATIO = 2
 
-def compute_cache(repo_path, file_list, json_hashes_path, algorithm='sha256',
-                                 max_size=10 * 1024 * 1024, sample_size=64 * 1024):
+def summaries_path(json_hashes_path):
+    """Path of the summaries file belonging to a hash cache"""
+    return os.path.join(os.path.dirname(json_hashes_path), SUMMARIES_FILE)
+
+def load_cache(json_hashes_path):
+    """
+    Load the stored hash cache and summaries, or an empty cache if they are missing or unreadable.
+
+    cache['summary_records'] counts the records in the summaries file for save_cache, or is None
+    when the file must be rewritten: summaries stored inside the hash cache by older versions,
+    or a last record cut off by an interrupted write.
+    """
+    try:
+        with open(json_hashes_path, 'rb') as f:
+            cache = orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        cache = {}
+
+    # Ensure the cache has the required structure
+    for key in ('hashes', 'summaries', 'stats'):
+        cache.setdefault(key, {})
+
+    records = None if cache['summaries'] else 0
+    try:
+        with open(summaries_path(json_hashes_path), 'rb') as f:
+            count = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    records = None
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue
+                count += 1
+                if record.get('summary') is None:
+                    cache['summaries'].pop(record['path'], None)
+                else:
+                    cache['summaries'][record['path']] = record['summary']
+        if records is not None:
+            records = count
+    except FileNotFoundError:
+        pass
+    cache['summary_records'] = records
+    return cache
+
+def save_cache(json_hashes_path, cache, stored_summaries):
+    """
+    Write the hash cache, appending only the summaries that differ from stored_summaries, as
+    loaded at the start of the run, to the summaries file.
+
+    The summaries file is rewritten with just the live summaries when load_cache asked for it or
+    it would hold more than SUMMARIES_COMPACT_RATIO records per live summary. The summaries are
+    written first, so an interrupted save at worst re-documents files whose hashes were not saved.
+    """
+    summaries = cache['summaries']
+    changed = [(path, summary) for path, summary in summaries.items() if stored_summaries.get(path) != summary]
+    changed += [(path, None) for path in stored_summaries if path not in summaries]
+
+    path = summaries_path(json_hashes_path)
+    records = cache.get('summary_records')
+    if records is None or records + len(changed) > SUMMARIES_COMPACT_RATIO * max(len(summaries), 1):
+        write_file_atomic(path, b"".join(orjson.dumps({'path': p, 'summary': summary}) + b"\n" for p, summary in summaries.items()))
+        cache['summary_records'] = len(summaries)
+    elif changed:
+        with open(path, 'ab') as f:
+            f.write(b"".join(orjson.dumps({'path': p, 'summary': summary}) + b"\n" for p, summary in changed))
+        cache['summary_records'] = records + len(changed)
+
+    hashes = {key: cache[key] for key in ('hashes', 'stats', 'algorithm') if key in cache}
+    write_file_atomic(json_hashes_path, orjson.dumps(hashes, option=orjson.OPT_INDENT_2))
+
+def compute_cache(repo_path, file_list, json_hashes_path, algorithm=DEFAULT_HASH_ALGORITHM,
+                                 max_workers=None, stored_cache=None):
     """
     Checks a list of files against a stored JSON of hashes. Returns only those files
     that are new or whose content has changed. If the stored hash file is missing or empty,
     it returns all files. The new hash values are saved to the JSON file.
 
+    Each hash is stored with the file's (size, mtime_ns) fingerprint. A file whose fingerprint
+    still matches is given its stored hash without being read; any other file is hashed, so a
+    touched but unmodified file is still reported unchanged.
+
+    Files that need hashing are hashed concurrently by max_workers threads (the
+    ThreadPoolExecutor default if None). Both hashlib and xxhash release the GIL while hashing,
+    so this uses several cores without the cost of sending work to a process pool.
+
     Args:
         file_list (list of str): List of file paths to check.
         json_hashes_path (str): Path to the JSON file storing file hashes.
-        algorithm (str): Hashing algorithm (default 'sha256').
-        max_size (int): File size threshold for partial hashing.
-        sample_size (int): Sample size in bytes for hashing large files.
+        algorithm (str): Hashing algorithm (default 'xxh3_128'). If the stored hashes were made
+            with a different algorithm, files are also hashed with that one for this run, so
+            switching algorithms rewrites the stored hashes without reporting files as changed.
+        max_workers (int): Number of threads hashing files.
+        stored_cache (dict): The stored cache if the caller has already loaded it, in which
+            case json_hashes_path is not read.
 
     Returns:
         list of str: Files that have changed or are not present in the stored hashes.
     """
     # Load previous hashes if available
-    try:
-        with open(json_hashes_path, 'r') as f:
-            stored_cache = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        stored_cache = {'hashes': {}, 'summaries': {}}
-
-    # Ensure stored_cache has the required structure
-    if 'hashes' not in stored_cache:
-        stored_cache['hashes'] = {}
-    if 'summaries' not in stored_cache:
-        stored_cache['summaries'] = {}
+    if stored_cache is None:
+        stored_cache = load_cache(json_hashes_path)
 
     # Determine if we should consider all files changed
     full_run = not stored_cache or not stored_cache['hashes'] or len(stored_cache['hashes']) == 0
 
-    new_cache = {'hashes': {}, 'summaries': {}}
+    # Caches written before the algorithm was recorded used SHA-256
+    stored_algorithm = stored_cache.get('algorithm', 'sha256')
+    migrating = not full_run and stored_algorithm != algorithm
+
+    new_cache = {'hashes': {}, 'summaries': {}, 'stats': {}, 'algorithm': algorithm}
     changed_files = []
 
+    present = []
+    to_hash = []
+    # Hash of each file comparable with its stored hash, i.e. made with the stored algorithm
+    comparable = {}
     for filepath in file_list:
         full_path = os.path.join(repo_path, filepath)
-        if not os.path.isfile(full_path):
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
             continue
 
-        new_hash = compute_file_hash(full_path, algorithm=algorithm,
-                                     max_size=max_size, sample_size=sample_size)
-        new_cache['hashes'][filepath] = new_hash
+        fingerprint = [st.st_size, st.st_mtime_ns]
+        present.append(filepath)
+        new_cache['stats'][filepath] = fingerprint
+        stored_hash = stored_cache['hashes'].get(filepath)
+        if not full_run and stored_hash and stored_cache['stats'].get(filepath) == fingerprint:
+            comparable[filepath] = stored_hash
+            if not migrating:
+                new_cache['hashes'][filepath] = stored_hash
+                continue
+        to_hash.append(filepath)
+
+    factory = hasher_factory(algorithm)
+    stored_factory = hasher_factory(stored_algorithm) if migrating else None
+
+    def hash_file(filepath):
+        full_path = os.path.join(repo_path, filepath)
+        # The size from the fingerprint saves compute_file_hash another stat
+        file_size = new_cache['stats'][filepath][0]
+        new_hash = compute_file_hash(full_path, factory=factory, file_size=file_size)
+        if migrating and filepath not in comparable:
+            return new_hash, compute_file_hash(full_path, factory=stored_factory, file_size=file_size)
+        return new_hash, new_hash
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for filepath, (new_hash, comparable_hash) in zip(to_hash, executor.map(hash_file, to_hash)):
+            new_cache['hashes'][filepath] = new_hash
+            comparable.setdefault(filepath, comparable_hash)
+
+    for filepath in present:
         # If a full run (no previous hashes) or if the file is new/changed, add to changed list.
-        if full_run or stored_cache['hashes'].get(filepath) != new_hash:
+        if full_run or stored_cache['hashes'].get(filepath) != comparable[filepath]:
             changed_files.append(filepath)
 
     return changed_files, new_cache
@@ -216,23 +385,171 @@ import random
 import json
 from botocore.exceptions import ClientError
 
-def bedrock_generate(prompt: str, model_id='anthropic.claude-3-sonnet-20240229-v1:0', temperature=0) -> str:
-    """Generate text using AWS Bedrock AI model with exponential backoff for ThrottlingExceptions"""
-    #estimate the number of tokens needed
-    max_tokens = 2**math.ceil(math.log(len(prompt)/3, 2))
+# Output token limits of the models in use; requests above the limit are rejected outright
+MODEL_MAX_TOKENS = {
+    'anthropic.claude-3-sonnet-20240229-v1:0': 4096,
+}
+DEFAULT_MODEL_MAX_TOKENS = 4096
+
+# Smallest output budget requested, so short prompts still leave room for an answer
+MIN_MAX_TOKENS = 256
+
+def estimate_max_tokens(prompt: str, model_id: str = 'anthropic.claude-3-sonnet-20240229-v1:0') -> int:
+    """
+    Estimate the output token budget for a prompt: the power of two at or above a third of its
+    length, clamped to the model's output limit.
+    """
+    estimate = max(MIN_MAX_TOKENS, 1 << (len(prompt) // 3 - 1).bit_length())
+    limit = MODEL_MAX_TOKENS.get(model_id, DEFAULT_MODEL_MAX_TOKENS)
+    if estimate > limit:
+        logger.debug("Clamping max tokens from %d to the %s limit of %d", estimate, model_id, limit)
+        return limit
+    return estimate
+
+# Directory of cached Bedrock responses, set by process_repository. None disables the cache.
+response_cache_dir = None
+
+# Cached responses not written or read for this long are removed by prune_response_cache
+RESPONSE_CACHE_MAX_AGE = 30 * 24 * 60 * 60  # seconds
+
+def response_cache_path(prompt: str, model_id: str, temperature: float) -> str:
+    """Return the cache file for a prompt, keyed on everything that determines the response"""
+    key = hashlib.sha256(f"{model_id}\n{temperature}\n{prompt}".encode('utf-8')).hexdigest()
+    return os.path.join(response_cache_dir, f"{key}.txt")
+
+def discard_cached_response(prompt: str, model_id: str, temperature: float):
+    """Remove a cached response that turned out to be unusable, so it is not replayed"""
+    if not response_cache_dir:
+        return
+    try:
+        os.remove(response_cache_path(prompt, model_id, temperature))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("Could not remove cached response: %s", e)
+
+def prune_response_cache():
+    """
+    Delete cached responses unused for RESPONSE_CACHE_MAX_AGE, so the cache does not grow without
+    bound. Hits refresh an entry's mtime, and entries for unchanged files are kept until they age
+    out, since those files make no requests to mark them as used.
+    """
+    if not response_cache_dir:
+        return
+    cutoff = time.time() - RESPONSE_CACHE_MAX_AGE
+    with os.scandir(response_cache_dir) as entries:
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError as e:
+                logger.debug("Could not remove cached response %s: %s", entry.path, e)
+
+# Process umask, read once at import since os.umask can only be queried by setting it
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def write_file_atomic(path: str, data):
+    """
+    Atomically replace a file with text or bytes so concurrent or interrupted runs never see partial
+    contents. The replacement keeps the existing file's permissions, or gets the usual umask-based
+    ones for a new file, rather than the owner-only mode of a temporary file.
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        mode = 0o666 & ~UMASK
+
+    text = not isinstance(data, bytes)
+    f = tempfile.NamedTemporaryFile(mode='w' if text else 'wb', encoding='utf-8' if text else None,
+                                    dir=os.path.dirname(path), delete=False)
+    try:
+        with f:
+            f.write(data)
+        os.chmod(f.name, mode)
+        os.replace(f.name, path)
+    except BaseException:
+        try:
+            os.unlink(f.name)
+        except OSError:
+            pass
+        raise
+
+# Maximum number of Bedrock requests in flight at once, across all worker threads
+BEDROCK_CONCURRENCY = 8
+bedrock_limit = BEDROCK_CONCURRENCY
+bedrock_slots = threading.BoundedSemaphore(BEDROCK_CONCURRENCY)
+
+def set_bedrock_concurrency(limit: int):
+    """Change the number of Bedrock requests allowed in flight; call before any requests start"""
+    global bedrock_slots, bedrock_limit
+    bedrock_limit = max(1, limit)
+    bedrock_slots = threading.BoundedSemaphore(bedrock_limit)
+    # Re-create the client so its connection pool covers the new limit
+    get_bedrock.cache_clear()
+
+# Whether to request latency-optimized inference at all, cleared by --standard-latency
+latency_optimized_inference = True
+
+# Models that rejected latency-optimized inference; they are sent standard requests from then on
+standard_latency_models = set()
+
+def is_latency_unsupported_error(error: ClientError) -> bool:
+    """Whether a ValidationException rejects the latency-optimized performance config itself"""
+    message = error.response['Error'].get('Message', '').lower()
+    return 'latency' in message or 'performanceconfig' in message or 'performance config' in message
+
+def bedrock_generate(prompt: str, model_id='anthropic.claude-3-sonnet-20240229-v1:0', temperature=0,
+                     use_cache=True, max_tokens: Optional[int] = None) -> str:
+    """
+    Generate text using the Bedrock Converse API with exponential backoff for ThrottlingExceptions.
+
+    Requests ask for latency-optimized inference. Only some models and regions support it, so a
+    ValidationException rejecting the performance config marks the model as standard-only and the
+    call is retried without it. Other validation errors fail the call as usual.
+
+    max_tokens defaults to estimate_max_tokens of the prompt.
+
+    When response_cache_dir is set and use_cache is not False, responses are cached on disk and
+    identical requests are answered without calling Bedrock. Truncated responses are not cached,
+    and failing to write the cache never discards a response.
+    """
+    cache_path = None
+    if response_cache_dir and use_cache:
+        cache_path = response_cache_path(prompt, model_id, temperature)
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                text = f.read()
+        except FileNotFoundError:
+            text = None
+        except (OSError, UnicodeDecodeError) as e:
+            logger.warning("Ignoring unreadable cached response %s: %s", cache_path, e)
+            text = None
+        if text is not None:
+            # Refresh the entry so prune_response_cache keeps responses that are still in use
+            try:
+                os.utime(cache_path)
+            except OSError:
+                pass
+            return text
+
+    if max_tokens is None:
+        max_tokens = estimate_max_tokens(prompt, model_id)
 
-    body = {
-        "anthropic_version": "bedrock-2023-05-31",
-        "max_tokens": max_tokens,
+    request = {
+        "modelId": model_id,
         "messages": [
             {
                 "role": "user",
-                "content": prompt
+                "content": [{"text": prompt}]
             }
         ],
-        "temperature": temperature,
-        "top_k": 1,
-        "top_p": 1.0
+        "inferenceConfig": {
+            "maxTokens": max_tokens,
+            "temperature": temperature,
+            "topP": 1.0
+        },
+        "additionalModelRequestFields": {"top_k": 1}
     }
 
     max_retries = 10
@@ -240,45 +557,145 @@ def bedrock_generate(prompt: str, model_id='anthropic.claude-3-sonnet-20240229-v
     backoff_factor = 2
     jitter = 0.1  # 10% jitter
 
-    for attempt in range(max_retries + 1):
+    # Falling back to standard latency does not use up an attempt; it happens at most once per model
+    attempt = 0
+    while True:
+        latency_optimized = latency_optimized_inference and model_id not in standard_latency_models
+        if latency_optimized:
+            request["performanceConfig"] = {"latency": "optimized"}
+        else:
+            request.pop("performanceConfig", None)
+
         try:
-            response = bedrock.invoke_model(
-                modelId=model_id,
-                body=json.dumps(body),
-                contentType='application/json',
-                accept='application/json'
-            )
+            with bedrock_slots:
+                response = get_bedrock().converse(**request)
 
             try:
-                raw = response['body'].read().decode('utf-8')
-                data = json.loads(raw)
-                if data['stop_reason'] == 'max_tokens':
-                    tqdm.write(f"Warning: Output truncated, max tokens reached {max_tokens}")
-                return data['content'][0]['text'].strip()
+                truncated = response['stopReason'] == 'max_tokens'
+                if truncated:
+                    logger.warning("Output truncated, max tokens reached %d", max_tokens)
+                text = response['output']['message']['content'][0]['text'].strip()
             except Exception as e:
-                tqdm.write("Error parsing Bedrock response:", str(e))
+                logger.error("Error parsing Bedrock response: %s", e)
                 return ""
 
+            if cache_path and text and not truncated:
+                try:
+                    write_file_atomic(cache_path, text.encode('utf-8'))
+                except OSError as e:
+                    logger.warning("Could not cache Bedrock response: %s", e)
+            return text
+
         except ClientError as e:
             error_code = e.response['Error']['Code']
+            if error_code == 'ValidationException' and latency_optimized and is_latency_unsupported_error(e):
+                logger.info("Latency-optimized inference unavailable for %s, using standard inference", model_id)
+                standard_latency_models.add(model_id)
+                continue
             if error_code == 'ThrottlingException' and attempt < max_retries:
-                tqdm.write(f"Error invoking Bedrock model. Attempt: {attempt}, Error: {error_code} {str(e)}; Retrying...")
+                logger.info("Error invoking Bedrock model. Attempt: %d, Error: %s %s; Retrying...", attempt, error_code, e)
                 # Calculate delay with exponential backoff and jitter
                 delay = initial_delay * (backoff_factor ** attempt)
                 delay *= random.uniform(1 - jitter, 1 + jitter)
                 time.sleep(delay)
+                attempt += 1
                 continue
             else:
-                tqdm.write(f"Error invoking Bedrock model. Attempt: {attempt}, Error: {error_code} {str(e)}")
+                logger.error("Error invoking Bedrock model. Attempt: %d, Error: %s %s", attempt, error_code, e)
                 # Re-raise the exception if it's not a ThrottlingException or retries are exhausted
                 return ""
         except Exception as e:
             # Handle any other exceptions that occur during the API call
-            tqdm.write(f"Unexpected error: {str(e)}")
-            traceback.print_exc()
+            logger.exception("Unexpected error: %s", e)
 
             return ""
 
+# Bedrock rejects batch inference jobs with fewer records than this
+BATCH_MIN_RECORDS = 100
+
+def bedrock_batch_generate(prompts: Dict[str, str], bucket: str, role_arn: str,
+                           model_id='anthropic.claude-3-sonnet-20240229-v1:0', poll_interval=30) -> Dict[str, str]:
+    """
+    Generate text for many prompts with a single Bedrock batch inference job.
+
+    The prompts are written as a JSONL file to S3, processed by one CreateModelInvocationJob,
+    and the results are read back once the job finishes. This trades latency for throughput and
+    is not subject to the on-demand request quota.
+
+    Args:
+        prompts (dict): Mapping of caller-chosen key to prompt text.
+        bucket (str): S3 bucket the job reads its input from and writes its output to.
+        role_arn (str): IAM service role Bedrock assumes to access the bucket.
+        model_id (str): Model to run the prompts against.
+        poll_interval (int): Seconds between job status checks.
+
+    Returns:
+        dict: Mapping of key to generated text, for every record the job completed.
+    """
+    region = get_bedrock().meta.region_name
+    bedrock_control = boto3.client('bedrock', region_name=region)
+    s3 = boto3.client('s3', region_name=region)
+
+    job_name = f"wraith-{int(time.time())}-{random.randint(0, 9999):04d}"
+    prefix = f"wraith-batch/{job_name}"
+
+    # Bedrock record ids are limited in format, so map our keys onto numbered ids
+    keys = {}
+    records = []
+    for index, (key, prompt) in enumerate(prompts.items()):
+        record_id = f"{index:011d}"
+        keys[record_id] = key
+        records.append(json.dumps({
+            "recordId": record_id,
+            "modelInput": {
+                "anthropic_version": "bedrock-2023-05-31",
+                # Documentation and summary share one response, so give it the whole output budget
+                "max_tokens": MODEL_MAX_TOKENS.get(model_id, DEFAULT_MODEL_MAX_TOKENS),
+                "messages": [{"role": "user", "content": prompt}],
+                "temperature": 0,
+                "top_k": 1,
+                "top_p": 1.0
+            }
+        }))
+
+    s3.put_object(Bucket=bucket, Key=f"{prefix}/input.jsonl", Body="\n".join(records).encode('utf-8'))
+
+    job = bedrock_control.create_model_invocation_job(
+        jobName=job_name,
+        roleArn=role_arn,
+        modelId=model_id,
+        inputDataConfig={'s3InputDataConfig': {'s3Uri': f"s3://{bucket}/{prefix}/input.jsonl"}},
+        outputDataConfig={'s3OutputDataConfig': {'s3Uri': f"s3://{bucket}/{prefix}/output/"}}
+    )
+    logger.info("Submitted Bedrock batch job %s with %d records", job_name, len(records))
+
+    while True:
+        status = bedrock_control.get_model_invocation_job(jobIdentifier=job['jobArn'])['status']
+        if status in ('Completed', 'PartiallyCompleted'):
+            break
+        if status in ('Failed', 'Stopped', 'Expired'):
+            raise RuntimeError(f"Bedrock batch job {job_name} ended with status {status}")
+        time.sleep(poll_interval)
+
+    results = {}
+    listing = s3.list_objects_v2(Bucket=bucket, Prefix=f"{prefix}/output/")
+    for obj in listing.get('Contents', []):
+        if not obj['Key'].endswith('.jsonl.out'):
+            continue
+        body = s3.get_object(Bucket=bucket, Key=obj['Key'])['Body'].read().decode('utf-8')
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            output = record.get('modelOutput')
+            if record.get('recordId') not in keys or not output:
+                continue
+            if output.get('stop_reason') == 'max_tokens':
+                logger.warning("Output truncated for %s, max tokens reached", keys[record['recordId']])
+            results[keys[record['recordId']]] = output['content'][0]['text'].strip()
+
+    return results
+
 def get_language_config(enable_langs: Optional[List[str]] = None,
                       disable_langs: Optional[List[str]] = None) -> Dict:
     """Return filtered language configuration"""
@@ -289,14 +706,13 @@ def get_language_config(enable_langs: Optional[List[str]] = None,
         return {k: v for k, v in LANGUAGE_CONFIG.items() if k in enable_langs}
     return {k: v for k, v in LANGUAGE_CONFIG.items() if k not in disable_langs}
 
-# Generates comprehensive documentation for a given code file using AWS Bedrock AI.
-# The documentation includes a brief summary, description of key components,
-# and overview of important classes, functions, and their relationships.
-# Input: code (str) - source code to document, file_path (str) - path to source file
-# Output: str - generated documentation in markdown format
-def generate_documentation(code, file_path):
-    """Generate documentation using Bedrock"""
-    prompt = (
+def extension_languages(config: Dict) -> Dict[str, str]:
+    """Map each extension in a language configuration to its language, for O(1) lookup per file"""
+    return {ext: lang for lang, cfg in config.items() for ext in cfg['extensions']}
+
+def make_doc_and_summary_prompt(code, file_path):
+    """Build the per-file prompt asking for both the documentation and its summary as JSON"""
+    return (
         f"<s><instructions>\nYou are an expert software engineer and technical writer. "
         f"Your task is to analyze this file and generate concise but technically detailed documentation.\n\n"
         f"Please provide:\n"
@@ -307,12 +723,116 @@ def generate_documentation(code, file_path):
         f"5. Core dependencies and integration points (ignore third-party library details)\n"
         f"6. Rather than file names, you should use component names and application features, making it more abstracted and easier to understand.\n"
         f"7. The goal is that the documentation you produce should be so good that a developer who hadn't seen the codebase before could understand the application just by reading the documentation.\n\n"
-        f"Format your response in clear, concise markdown.\n"
-        f"Keep each section brief but information-dense.\n</instructions>\n\n"
+        f"Format the documentation in clear, concise markdown.\n"
+        f"Keep each section brief but information-dense.\n\n"
+        f"Also write a concise summary. Using the information available in the code file '{os.path.basename(file_path)}', determine what the application component is and what it does in the context of the wider application. "
+        f"You must determine the name of the application component and use it as the heading of the summary, not the file name.\n\n"
+        f"Respond with ONLY a JSON object with two string fields: \"documentation\" containing the markdown documentation, and \"summary\" containing the markdown summary.\n</instructions>\n\n"
         f"<code>\n{code}</code>\n\n"
-        f"Documentation:"
+        f"JSON:"
     )
-    return bedrock_generate(prompt)
+
+def make_grouped_doc_and_summary_prompt(files):
+    """Build one prompt asking for the documentation and summary of several files, as JSON keyed by path"""
+    sources = "".join(f"<file path=\"{path}\">\n{code}</file>\n" for path, code in files)
+    return (
+        f"<s><instructions>\nYou are an expert software engineer and technical writer. "
+        f"Your task is to analyze each of the following files and generate concise but technically detailed documentation for each one.\n\n"
+        f"For each file, please provide:\n"
+        f"1. A single-sentence overview of the application components purpose\n"
+        f"2. Key technical components with their specific purposes\n"
+        f"3. Critical algorithms, patterns, or technical implementations\n"
+        f"4. Security considerations specific to the code's functionality\n"
+        f"5. Core dependencies and integration points (ignore third-party library details)\n"
+        f"6. Rather than file names, you should use component names and application features, making it more abstracted and easier to understand.\n"
+        f"7. The goal is that the documentation you produce should be so good that a developer who hadn't seen the codebase before could understand the application just by reading the documentation.\n\n"
+        f"Format the documentation in clear, concise markdown.\n"
+        f"Keep each section brief but information-dense.\n\n"
+        f"Also write a concise summary of each file. Using the information available in the file, determine what the application component is and what it does in the context of the wider application. "
+        f"You must determine the name of the application component and use it as the heading of the summary, not the file name.\n\n"
+        f"Respond with ONLY a JSON object with one key per file path, exactly as given in the path attribute. Each value must be an object with two string fields: \"documentation\" containing the markdown documentation, and \"summary\" containing the markdown summary.\n</instructions>\n\n"
+        f"<files>\n{sources}</files>\n\n"
+        f"JSON:"
+    )
+
+def parse_grouped_doc_and_summary(response: str, paths: List[str]) -> Dict[str, str]:
+    """
+    Split a grouped documentation and summary response into per-file responses.
+
+    Each file's entry is returned re-serialized as the JSON object parse_doc_and_summary expects.
+    Files missing from the response or without documentation, or the whole group if it is not
+    valid JSON, are left out.
+    """
+    start, end = response.find('{'), response.rfind('}')
+    if start == -1 or end <= start:
+        return {}
+    try:
+        data = json.loads(response[start:end + 1], strict=False)
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    results = {}
+    for path in paths:
+        entry = data.get(path)
+        if isinstance(entry, dict) and isinstance(entry.get('documentation'), str) and entry['documentation'].strip():
+            results[path] = json.dumps(entry)
+    return results
+
+def parse_doc_and_summary(response: str):
+    """
+    Split a combined documentation and summary response.
+
+    Returns a (documentation, summary) tuple, with a None summary if the response has none. If
+    the response is not the requested JSON object, for example because it was cut off at the
+    token limit, returns None rather than passing the raw JSON off as documentation.
+    """
+    start, end = response.find('{'), response.rfind('}')
+    if start != -1 and end > start:
+        try:
+            data = json.loads(response[start:end + 1], strict=False)
+            if isinstance(data, dict) and isinstance(data.get('documentation'), str) and data['documentation'].strip():
+                summary = data.get('summary')
+                return data['documentation'].strip(), summary.strip() if isinstance(summary, str) and summary.strip() else None
+        except json.JSONDecodeError:
+            pass
+    return None
+
+# Number of times a file's documentation is requested before giving up on unusable responses
+DOC_MAX_ATTEMPTS = 2
+
+# Generates comprehensive documentation and a summary for a given code file using AWS Bedrock AI.
+# The documentation includes a brief summary, description of key components,
+# and overview of important classes, functions, and their relationships.
+# Both are requested in a single call with the model's full output budget, since they share
+# one response; the summary falls back to a separate call if the response has none. A response
+# that is not the requested JSON is requested again, bypassing the cache, up to
+# DOC_MAX_ATTEMPTS times before the file fails.
+# Input: code (str) - source code to document, file_path (str) - path to source file,
+#        response (str) - an already generated response to the prompt, e.g. from a batch job
+# Output: (str, str) - generated documentation and summary in markdown format
+def generate_doc_and_summary(code, file_path, response=None):
+    """Generate documentation and its summary using Bedrock"""
+    model_id = 'anthropic.claude-3-sonnet-20240229-v1:0'
+    parsed = parse_doc_and_summary(response) if response else None
+
+    prompt = make_doc_and_summary_prompt(code, file_path)
+    for attempt in range(DOC_MAX_ATTEMPTS):
+        if parsed:
+            break
+        use_cache = attempt == 0
+        response = bedrock_generate(prompt, model_id=model_id, use_cache=use_cache,
+                                    max_tokens=MODEL_MAX_TOKENS.get(model_id, DEFAULT_MODEL_MAX_TOKENS))
+        parsed = parse_doc_and_summary(response)
+        if not parsed and use_cache:
+            discard_cached_response(prompt, model_id, 0)
+    if not parsed:
+        raise ValueError(f"No usable documentation response for {file_path}")
+
+    doc, summary = parsed
+    if not summary:
+        summary = generate_summary(doc, file_path)
+    return doc, summary
 
 def generate_summary(documentation, file_path):
     """Generate a summary of the documentation"""
@@ -326,207 +846,212 @@ def generate_summary(documentation, file_path):
     )
     return bedrock_generate(prompt)
 
+# Instructions of the threat model prompts, rendered once; only the documentation sample varies
+THREAT_MODEL_INSTRUCTIONS = (
+    f"<s>You are an expert security architect. Create a threat model diagram based on the provided documentation.\n\n"
+    f"Requirements:\n"
+    f"1. Use mermaid.js flowchart TD syntax\n"
+    f"2. Node types:\n"
+    f"   - ((name)) for external entities/users\n"
+    f"   - [name] for internal processes\n"
+    f"   - [(name)] for data stores\n"
+    f"   - {{{{name}}}} for security controls\n"
+    f"   - >name] for outputs\n\n"
+    f"3. Node Labels MUST:\n"
+    f"   - Extract ACTUAL application name from the documentation (e.g., if docs mention 'MyApp', use 'MyApp')\n"
+    f"   - Extract ACTUAL service names from the documentation (e.g., if docs mention 'auth-service', use 'auth-service')\n"
+    f"   - Extract ACTUAL database names from the documentation (e.g., if docs mention 'users-db', use 'users-db')\n"
+    f"   - Extract ACTUAL API service names from the documentation (e.g., if docs mention 'orders-api', use 'orders-api')\n"
+    f"   - NEVER use generic names like 'example.com' or 'Web Browser'\n"
+    f"   - NEVER make up names - use ONLY names found in the documentation\n"
+    f"   - NEVER USE FILE NAMES IN THE DIAGRAM - USE COMPONENT NAMES\n\n"
+    f"4. Data Flow Labels MUST:\n"
+    f"   - Use ONLY alphanumeric characters, spaces, and underscores in labels\n"
+    f"   - NO special characters like /, (, ), [, ], {{, }}, etc.\n"
+    f"   - Be SPECIFIC about the data being transmitted (e.g., 'user_login_credentials' instead of 'auth_request')\n"
+    f"   - Include the type of data (e.g., 'user_profile_data' instead of 'http_request')\n"
+    f"   - For API endpoints, use format: 'create_user_profile_data' instead of 'api_tickets_create'\n"
+    f"   - For state changes, use format: 'raw_user_data_to_validated' instead of 'raw_to_validated'\n"
+    f"   - For data fields, use format: 'user_id_and_permissions' instead of 'user_id_roles'\n"
+    f"   - Use actual field names and types from the documentation\n\n"
+    f"5. Trust Boundaries:\n"
+    f"   - Use subgraphs with descriptive names based on actual system zones\n"
+    f"   - Label cross-boundary data flows with specific protocols/methods\n"
+    f"   - Use format: 'encrypted_user_credentials' instead of 'http_request'\n\n"
+    f"Example structure (using specific data types):\n"
+    f"```mermaid\n"
+    f"flowchart TD\n"
+    f"    %% Styles\n"
+    f"    classDef user fill:#fdd,stroke:#333,stroke-width:2px\n"
+    f"    classDef process fill:#ddf,stroke:#333,stroke-width:2px\n"
+    f"    classDef storage fill:#dfd,stroke:#333,stroke-width:2px\n"
+    f"    classDef control fill:#fff,stroke:#f66,stroke-width:3px\n"
+    f"    classDef external fill:#fdb,stroke:#333,stroke-width:2px\n"
+    f"    \n"
+    f"    %% Trust Boundaries\n"
+    f"    subgraph ClientZone[MyApp]\n"
+    f"        User((Customer))\n"
+    f"        Frontend[MyApp Frontend]\n"
+    f"    end\n"
+    f"    \n"
+    f"    subgraph APIZone[MyApp API]\n"
+    f"        Auth{{{{auth-service}}}}\n"
+    f"        API[orders-service]\n"
+    f"        DB[(orders-db)]\n"
+    f"    end\n"
+    f"    \n"
+    f"    %% Data Flows with Specific Types\n"
+    f"    User -->|user_login_credentials| Frontend\n"
+    f"    Frontend -->|encrypted_user_credentials| Auth\n"
+    f"    Auth -->|validated_user_session| API\n"
+    f"    API -->|order_transaction_data| DB\n"
+    f"    DB -->|order_details_data| API\n"
+    f"    API -->|order_confirmation_data| Frontend\n"
+    f"    \n"
+    f"    %% Apply styles\n"
+    f"    class User user\n"
+    f"    class Auth control\n"
+    f"    class API process\n"
+    f"    class DB storage\n"
+    f"    class Frontend process\n"
+    f"```\n\n"
+    f"IMPORTANT:\n"
+    f"1. Extract ACTUAL application and service names from the documentation - NEVER use generic examples\n"
+    f"2. Convert all data labels, object names, and other label names into safe format but include data type (e.g., 'create_user_profile_data')\n"
+    f"3. Show REAL data transformations between components\n"
+    f"4. Label boundaries based on ACTUAL system architecture\n"
+    f"5. Include only components and flows from documentation\n"
+    f"6. Make data flow labels as specific as possible about the actual data being transmitted\n"
+    f"7. Return ONLY the mermaid.js diagram\n"
+    f"8. Use ONLY safe characters in labels (alphanumeric, spaces, underscores)\n"
+    f"9. When labelling objects, trust boundaries, data flows, and other components you must use the application name, and NOT the file name, e.g. ShoppingCart not shoppingcart.py\n"
+    f"10. You must ensure that all of the components of the application are represented in the diagram in a way that is consistent with the documentation.\n"
+    f"11. Every object you draw must have a connection to it, that actually makes sense in the context of the application we've just processed.\n\n"
+)
+
+REFINE_THREAT_MODEL_INSTRUCTIONS = (
+    f"<s><instructions>You are an expert security architect. Refine the given threat model based on the documentation.\n\n"
+    f"Requirements:\n"
+    f"1. Use mermaid.js flowchart TD syntax\n"
+    f"2. Node types:\n"
+    f"   - ((name)) for external entities/users\n"
+    f"   - [name] for internal processes\n"
+    f"   - [(name)] for data stores\n"
+    f"   - {{{{name}}}} for security controls\n"
+    f"   - >name] for outputs\n\n"
+    f"3. Node Labels MUST:\n"
+    f"   - Extract ACTUAL application name from the documentation (e.g., if docs mention 'MyApp', use 'MyApp')\n"
+    f"   - Extract ACTUAL service names from the documentation (e.g., if docs mention 'auth-service', use 'auth-service')\n"
+    f"   - Extract ACTUAL database names from the documentation (e.g., if docs mention 'users-db', use 'users-db')\n"
+    f"   - Extract ACTUAL API service names from the documentation (e.g., if docs mention 'orders-api', use 'orders-api')\n"
+    f"   - NEVER use generic names like 'example.com' or 'Web Browser'\n"
+    f"   - NEVER make up names - use ONLY names found in the documentation\n\n"
+    f"4. Data Flow Labels MUST:\n"
+    f"   - Use ONLY alphanumeric characters, spaces, and underscores in labels\n"
+    f"   - NO special characters like /, (, ), [, ], {{, }}, etc.\n"
+    f"   - Be SPECIFIC about the data being transmitted (e.g., 'user_login_credentials' instead of 'auth_request')\n"
+    f"   - Include the type of data (e.g., 'user_profile_data' instead of 'http_request')\n"
+    f"   - For API endpoints, use format: 'create_user_profile_data' instead of 'api_tickets_create'\n"
+    f"   - For state changes, use format: 'raw_user_data_to_validated' instead of 'raw_to_validated'\n"
+    f"   - For data fields, use format: 'user_id_and_permissions' instead of 'user_id_roles'\n"
+    f"   - Use actual field names and types from the documentation\n\n"
+    f"5. Trust Boundaries:\n"
+    f"   - Use subgraphs with descriptive names based on actual system zones\n"
+    f"   - Label cross-boundary data flows with specific protocols/methods\n"
+    f"   - Use format: 'encrypted_user_credentials' instead of 'http_request'\n\n"
+    f"Example structure (using specific data types):\n"
+    f"```mermaid\n"
+    f"flowchart TD\n"
+    f"    %% Styles\n"
+    f"    classDef user fill:#fdd,stroke:#333,stroke-width:2px\n"
+    f"    classDef process fill:#ddf,stroke:#333,stroke-width:2px\n"
+    f"    classDef storage fill:#dfd,stroke:#333,stroke-width:2px\n"
+    f"    classDef control fill:#fff,stroke:#f66,stroke-width:3px\n"
+    f"    classDef external fill:#fdb,stroke:#333,stroke-width:2px\n"
+    f"    \n"
+    f"    %% Trust Boundaries\n"
+    f"    subgraph ClientZone[MyApp]\n"
+    f"        User((Customer))\n"
+    f"        Frontend[MyApp Frontend]\n"
+    f"    end\n"
+    f"    \n"
+    f"    subgraph APIZone[MyApp API]\n"
+    f"        Auth{{{{auth-service}}}}\n"
+    f"        API[orders-service]\n"
+    f"        DB[(orders-db)]\n"
+    f"    end\n"
+    f"    \n"
+    f"    %% Data Flows with Specific Types\n"
+    f"    User -->|user_login_credentials| Frontend\n"
+    f"    Frontend -->|encrypted_user_credentials| Auth\n"
+    f"    Auth -->|validated_user_session| API\n"
+    f"    API -->|order_transaction_data| DB\n"
+    f"    DB -->|order_details_data| API\n"
+    f"    API -->|order_confirmation_data| Frontend\n"
+    f"    \n"
+    f"    %% Apply styles\n"
+    f"    class User user\n"
+    f"    class Auth control\n"
+    f"    class API process\n"
+    f"    class DB storage\n"
+    f"    class Frontend process\n"
+    f"```\n\n"
+    f"IMPORTANT:\n"
+    f"1. Extract ACTUAL application and service names from the documentation - NEVER use generic examples\n"
+    f"2. Convert all API endpoints to safe format but include data type (e.g., 'create_user_profile_data')\n"
+    f"3. Show REAL data transformations between components\n"
+    f"4. Label boundaries based on ACTUAL system architecture\n"
+    f"5. Include only components and flows from documentation\n"
+    f"6. Make data flow labels as specific as possible about the actual data being transmitted\n"
+    f"7. Return ONLY the mermaid.js diagram\n"
+    f"8. Use ONLY safe characters in labels (alphanumeric, spaces, underscores)\n</instructions>"
+    f"9. When labelling objects, trust boundaries, data flows, and other components you must use the application name, and NOT the file name, e.g. ShoppingCart not shoppingcart.py\n"
+    f"10. You must ensure that all of the components of the application are represented in the diagram in a way that is consistent with the documentation.\n"
+    f"11. Every object you draw must have a connection to it, that actually makes sense in the context of the application we've just processed.\n\n"
+)
+
+def sample_summaries(summaries, max_chars):
+    """
+    Serialize as many (path, summary) pairs as fit in max_chars, most informative first.
+
+    Summaries are ranked deterministically, longest first and then shallowest path, so large
+    repositories keep their most detailed components and the same documentation always gives
+    the same prompt. The longest prefix that fits is found by bisecting the cumulative
+    serialized lengths, instead of re-measuring the whole prompt for each smaller sample size.
+    """
+    ranked = sorted(summaries, key=lambda item: (-len(item[1]), item[0].count(os.sep), item[0]))
+    summaries = [f"Path: {path}, summary: {summary}" for path, summary in ranked]
+
+    # Each summary adds its length plus a ". " separator; the first has no separator
+    ends = list(itertools.accumulate(len(summary) + 2 for summary in summaries))
+    sample_size = bisect.bisect_right(ends, max_chars + 2)
+    if summaries and not sample_size:
+        raise ValueError("No summary fits in the threat model prompt")
+
+    if sample_size != len(summaries):
+        logger.warning("Codebase is large, reducing modelling accuracy to %d%%...", round(100/len(summaries)*sample_size)) #we should calculate how much accuracy we're losing
+    return ". ".join(summaries[:sample_size])
+
 def make_threat_model_prompt(summaries):
     claude_max_length = 128_000/4
 
-    #deal with prompts that are too large by randomly sampling the summaries, since we can't deal with everything
-    serialized_summary = None
-    prompt = ""
-    summaries = [f"Path: {path}, summary: {summary}" for path, summary in summaries]
-    sample_size = len(summaries)
-
-    while not serialized_summary or len(prompt) > claude_max_length:
-        serialized_summary = ". ".join(random.sample(summaries, sample_size))
-        prompt = (
-            f"<s>You are an expert security architect. Create a threat model diagram based on the provided documentation.\n\n"
-            f"Requirements:\n"
-            f"1. Use mermaid.js flowchart TD syntax\n"
-            f"2. Node types:\n"
-            f"   - ((name)) for external entities/users\n"
-            f"   - [name] for internal processes\n"
-            f"   - [(name)] for data stores\n"
-            f"   - {{{{name}}}} for security controls\n"
-            f"   - >name] for outputs\n\n"
-            f"3. Node Labels MUST:\n"
-            f"   - Extract ACTUAL application name from the documentation (e.g., if docs mention 'MyApp', use 'MyApp')\n"
-            f"   - Extract ACTUAL service names from the documentation (e.g., if docs mention 'auth-service', use 'auth-service')\n"
-            f"   - Extract ACTUAL database names from the documentation (e.g., if docs mention 'users-db', use 'users-db')\n"
-            f"   - Extract ACTUAL API service names from the documentation (e.g., if docs mention 'orders-api', use 'orders-api')\n"
-            f"   - NEVER use generic names like 'example.com' or 'Web Browser'\n"
-            f"   - NEVER make up names - use ONLY names found in the documentation\n"
-            f"   - NEVER USE FILE NAMES IN THE DIAGRAM - USE COMPONENT NAMES\n\n"
-            f"4. Data Flow Labels MUST:\n"
-            f"   - Use ONLY alphanumeric characters, spaces, and underscores in labels\n"
-            f"   - NO special characters like /, (, ), [, ], {{, }}, etc.\n"
-            f"   - Be SPECIFIC about the data being transmitted (e.g., 'user_login_credentials' instead of 'auth_request')\n"
-            f"   - Include the type of data (e.g., 'user_profile_data' instead of 'http_request')\n"
-            f"   - For API endpoints, use format: 'create_user_profile_data' instead of 'api_tickets_create'\n"
-            f"   - For state changes, use format: 'raw_user_data_to_validated' instead of 'raw_to_validated'\n"
-            f"   - For data fields, use format: 'user_id_and_permissions' instead of 'user_id_roles'\n"
-            f"   - Use actual field names and types from the documentation\n\n"
-            f"5. Trust Boundaries:\n"
-            f"   - Use subgraphs with descriptive names based on actual system zones\n"
-            f"   - Label cross-boundary data flows with specific protocols/methods\n"
-            f"   - Use format: 'encrypted_user_credentials' instead of 'http_request'\n\n"
-            f"Example structure (using specific data types):\n"
-            f"```mermaid\n"
-            f"flowchart TD\n"
-            f"    %% Styles\n"
-            f"    classDef user fill:#fdd,stroke:#333,stroke-width:2px\n"
-            f"    classDef process fill:#ddf,stroke:#333,stroke-width:2px\n"
-            f"    classDef storage fill:#dfd,stroke:#333,stroke-width:2px\n"
-            f"    classDef control fill:#fff,stroke:#f66,stroke-width:3px\n"
-            f"    classDef external fill:#fdb,stroke:#333,stroke-width:2px\n"
-            f"    \n"
-            f"    %% Trust Boundaries\n"
-            f"    subgraph ClientZone[MyApp]\n"
-            f"        User((Customer))\n"
-            f"        Frontend[MyApp Frontend]\n"
-            f"    end\n"
-            f"    \n"
-            f"    subgraph APIZone[MyApp API]\n"
-            f"        Auth{{{{auth-service}}}}\n"
-            f"        API[orders-service]\n"
-            f"        DB[(orders-db)]\n"
-            f"    end\n"
-            f"    \n"
-            f"    %% Data Flows with Specific Types\n"
-            f"    User -->|user_login_credentials| Frontend\n"
-            f"    Frontend -->|encrypted_user_credentials| Auth\n"
-            f"    Auth -->|validated_user_session| API\n"
-            f"    API -->|order_transaction_data| DB\n"
-            f"    DB -->|order_details_data| API\n"
-            f"    API -->|order_confirmation_data| Frontend\n"
-            f"    \n"
-            f"    %% Apply styles\n"
-            f"    class User user\n"
-            f"    class Auth control\n"
-            f"    class API process\n"
-            f"    class DB storage\n"
-            f"    class Frontend process\n"
-            f"```\n\n"
-            f"IMPORTANT:\n"
-            f"1. Extract ACTUAL application and service names from the documentation - NEVER use generic examples\n"
-            f"2. Convert all data labels, object names, and other label names into safe format but include data type (e.g., 'create_user_profile_data')\n"
-            f"3. Show REAL data transformations between components\n"
-            f"4. Label boundaries based on ACTUAL system architecture\n"
-            f"5. Include only components and flows from documentation\n"
-            f"6. Make data flow labels as specific as possible about the actual data being transmitted\n"
-            f"7. Return ONLY the mermaid.js diagram\n"
-            f"8. Use ONLY safe characters in labels (alphanumeric, spaces, underscores)\n"
-            f"9. When labelling objects, trust boundaries, data flows, and other components you must use the application name, and NOT the file name, e.g. ShoppingCart not shoppingcart.py\n"
-            f"10. You must ensure that all of the components of the application are represented in the diagram in a way that is consistent with the documentation.\n"
-            f"11. Every object you draw must have a connection to it, that actually makes sense in the context of the application we've just processed.\n\n"
-            f"Documentation to analyze:\n{serialized_summary}\n"
-            f"[/INST]"
-        )
-        sample_size -= 1
-    sample_size += 1
+    def render(serialized_summary):
+        return THREAT_MODEL_INSTRUCTIONS + f"Documentation to analyze:\n{serialized_summary}\n[/INST]"
 
-    if sample_size != len(summaries):
-        tqdm.write(f"Warning: Codebase is large, reducing modelling accuracy to {round(100/len(summaries)*sample_size)}%...") #we should calculate how much accuracy we're losing
-    return prompt
+    #deal with prompts that are too large by keeping the most detailed summaries, since we can't deal with everything
+    return render(sample_summaries(summaries, claude_max_length - len(render(""))))
 
 def refine_threat_model_prompt(summaries, graph):
     claude_max_length = 128_000/4
 
-    #deal with prompts that are too large by randomly sampling the summaries, since we can't deal with everything
-    serialized_summary = None
-    prompt = ""
-    summaries = [f"Path: {path}, summary: {summary}" for path, summary in summaries]
-    sample_size = len(summaries)
-
-    while not serialized_summary or len(prompt) > claude_max_length:
-        serialized_summary = ". ".join(random.sample(summaries, sample_size))
-        prompt = (
-            f"<s><instructions>You are an expert security architect. Refine the given threat model based on the documentation.\n\n"
-            f"Requirements:\n"
-            f"1. Use mermaid.js flowchart TD syntax\n"
-            f"2. Node types:\n"
-            f"   - ((name)) for external entities/users\n"
-            f"   - [name] for internal processes\n"
-            f"   - [(name)] for data stores\n"
-            f"   - {{{{name}}}} for security controls\n"
-            f"   - >name] for outputs\n\n"
-            f"3. Node Labels MUST:\n"
-            f"   - Extract ACTUAL application name from the documentation (e.g., if docs mention 'MyApp', use 'MyApp')\n"
-            f"   - Extract ACTUAL service names from the documentation (e.g., if docs mention 'auth-service', use 'auth-service')\n"
-            f"   - Extract ACTUAL database names from the documentation (e.g., if docs mention 'users-db', use 'users-db')\n"
-            f"   - Extract ACTUAL API service names from the documentation (e.g., if docs mention 'orders-api', use 'orders-api')\n"
-            f"   - NEVER use generic names like 'example.com' or 'Web Browser'\n"
-            f"   - NEVER make up names - use ONLY names found in the documentation\n\n"
-            f"4. Data Flow Labels MUST:\n"
-            f"   - Use ONLY alphanumeric characters, spaces, and underscores in labels\n"
-            f"   - NO special characters like /, (, ), [, ], {{, }}, etc.\n"
-            f"   - Be SPECIFIC about the data being transmitted (e.g., 'user_login_credentials' instead of 'auth_request')\n"
-            f"   - Include the type of data (e.g., 'user_profile_data' instead of 'http_request')\n"
-            f"   - For API endpoints, use format: 'create_user_profile_data' instead of 'api_tickets_create'\n"
-            f"   - For state changes, use format: 'raw_user_data_to_validated' instead of 'raw_to_validated'\n"
-            f"   - For data fields, use format: 'user_id_and_permissions' instead of 'user_id_roles'\n"
-            f"   - Use actual field names and types from the documentation\n\n"
-            f"5. Trust Boundaries:\n"
-            f"   - Use subgraphs with descriptive names based on actual system zones\n"
-            f"   - Label cross-boundary data flows with specific protocols/methods\n"
-            f"   - Use format: 'encrypted_user_credentials' instead of 'http_request'\n\n"
-            f"Example structure (using specific data types):\n"
-            f"```mermaid\n"
-            f"flowchart TD\n"
-            f"    %% Styles\n"
-            f"    classDef user fill:#fdd,stroke:#333,stroke-width:2px\n"
-            f"    classDef process fill:#ddf,stroke:#333,stroke-width:2px\n"
-            f"    classDef storage fill:#dfd,stroke:#333,stroke-width:2px\n"
-            f"    classDef control fill:#fff,stroke:#f66,stroke-width:3px\n"
-            f"    classDef external fill:#fdb,stroke:#333,stroke-width:2px\n"
-            f"    \n"
-            f"    %% Trust Boundaries\n"
-            f"    subgraph ClientZone[MyApp]\n"
-            f"        User((Customer))\n"
-            f"        Frontend[MyApp Frontend]\n"
-            f"    end\n"
-            f"    \n"
-            f"    subgraph APIZone[MyApp API]\n"
-            f"        Auth{{{{auth-service}}}}\n"
-            f"        API[orders-service]\n"
-            f"        DB[(orders-db)]\n"
-            f"    end\n"
-            f"    \n"
-            f"    %% Data Flows with Specific Types\n"
-            f"    User -->|user_login_credentials| Frontend\n"
-            f"    Frontend -->|encrypted_user_credentials| Auth\n"
-            f"    Auth -->|validated_user_session| API\n"
-            f"    API -->|order_transaction_data| DB\n"
-            f"    DB -->|order_details_data| API\n"
-            f"    API -->|order_confirmation_data| Frontend\n"
-            f"    \n"
-            f"    %% Apply styles\n"
-            f"    class User user\n"
-            f"    class Auth control\n"
-            f"    class API process\n"
-            f"    class DB storage\n"
-            f"    class Frontend process\n"
-            f"```\n\n"
-            f"IMPORTANT:\n"
-            f"1. Extract ACTUAL application and service names from the documentation - NEVER use generic examples\n"
-            f"2. Convert all API endpoints to safe format but include data type (e.g., 'create_user_profile_data')\n"
-            f"3. Show REAL data transformations between components\n"
-            f"4. Label boundaries based on ACTUAL system architecture\n"
-            f"5. Include only components and flows from documentation\n"
-            f"6. Make data flow labels as specific as possible about the actual data being transmitted\n"
-            f"7. Return ONLY the mermaid.js diagram\n"
-            f"8. Use ONLY safe characters in labels (alphanumeric, spaces, underscores)\n</instructions>"
-            f"9. When labelling objects, trust boundaries, data flows, and other components you must use the application name, and NOT the file name, e.g. ShoppingCart not shoppingcart.py\n"
-            f"10. You must ensure that all of the components of the application are represented in the diagram in a way that is consistent with the documentation.\n"
-            f"11. Every object you draw must have a connection to it, that actually makes sense in the context of the application we've just processed.\n\n"
-            f"<documentation>\n{serialized_summary}</documentation>\n"
-            f"<graph>\n{graph}</graph>\n"
-            f"[/INST]"
-        )
-        sample_size -= 1
-    sample_size += 1
+    def render(serialized_summary):
+        return REFINE_THREAT_MODEL_INSTRUCTIONS + f"<documentation>\n{serialized_summary}</documentation>\n<graph>\n{graph}</graph>\n[/INST]"
 
-    if sample_size != len(summaries):
-        tqdm.write(f"Warning: Codebase is large, reducing modelling accuracy to {round(100/len(summaries)*sample_size)}%...") #we should calculate how much accuracy we're losing
-    return prompt
+    #deal with prompts that are too large by keeping the most detailed summaries, since we can't deal with everything
+    return render(sample_summaries(summaries, claude_max_length - len(render(""))))
+
+# Number of times a threat model diagram is requested before giving up on invalid responses
+DIAGRAM_MAX_ATTEMPTS = 5
 
 # Analyzes code documentation to identify potential business logic issues and vulnerabilities.
 # Identifies issues like inconsistent error handling, missing edge cases,
@@ -536,29 +1061,11 @@ def refine_threat_model_prompt(summaries, graph):
 def generate_threat_model_diagram(summaries):
     """Generate a security-focused threat model diagram using mermaid.js"""
 
-    temperature = 0
-    while True:
-        try:
-            prompt = make_threat_model_prompt(summaries)
-
-            diagram = bedrock_generate(prompt, model_id='anthropic.claude-3-sonnet-20240229-v1:0')
-
-            if "```mermaid" in diagram:
-                diagram = diagram[diagram.find("```mermaid"):diagram.rfind("```")]
-                diagram = diagram.replace("```mermaid", "").replace("```", "").strip()
-
-            # Ensure the diagram has the required elements
-            required_elements = ["flowchart TD", "classDef", "-->", "subgraph"]
-            if not all(x in diagram for x in required_elements):
-                raise ValueError("Invalid diagram structure")
-
-            if not validate_mermaid(diagram):
-                raise ValueError("Invalid diagram syntax")
-
-            prompt = refine_threat_model_prompt(summaries, diagram)
-
-            diagram = bedrock_generate(prompt, model_id='anthropic.claude-3-sonnet-20240229-v1:0')
+    model_id = 'anthropic.claude-3-sonnet-20240229-v1:0'
 
+    def generate_checked_diagram(prompt, temperature, use_cache):
+        diagram = bedrock_generate(prompt, model_id=model_id, temperature=temperature, use_cache=use_cache)
+        try:
             if "```mermaid" in diagram:
                 diagram = diagram[diagram.find("```mermaid"):diagram.rfind("```")]
                 diagram = diagram.replace("```mermaid", "").replace("```", "").strip()
@@ -570,66 +1077,82 @@ def generate_threat_model_diagram(summaries):
 
             if not validate_mermaid(diagram):
                 raise ValueError("Invalid diagram syntax")
+        except ValueError:
+            # Never keep a cached diagram that is known to be bad
+            if use_cache:
+                discard_cached_response(prompt, model_id, temperature)
+            raise
+        return diagram
 
-            return diagram
+    temperature = 0
+    for attempt in range(DIAGRAM_MAX_ATTEMPTS):
+        # A cached response failed validation if we are retrying, so retries always call Bedrock
+        use_cache = attempt == 0
+        try:
+            diagram = generate_checked_diagram(make_threat_model_prompt(summaries), temperature, use_cache)
+            return generate_checked_diagram(refine_threat_model_prompt(summaries, diagram), temperature, use_cache)
         except ValueError as e:
-            temperature += 0.1
+            logger.info("Threat model diagram attempt %d failed: %s; retrying...", attempt + 1, e)
+            # Retry with more randomness; a deterministic response would fail the same way
+            temperature = min(round(temperature + 0.1, 1), 1.0)
+    raise ValueError(f"No valid threat model diagram after {DIAGRAM_MAX_ATTEMPTS} attempts")
 
 def get_gitignore_spec(repo_path):
-    """Load .gitignore patterns into a GitIgnoreSpec"""
-    gitignore_path = os.path.join(repo_path, '.gitignore')
-    if os.path.exists(gitignore_path):
-        with open(gitignore_path, 'r') as f:
-            lines = [line.strip() for line in f if line.strip() and not line.startswith('#')] + ['.git/']
-            return GitIgnoreSpec.from_lines(lines)
-    return None
-
-def truncate_code(code: str, section_regex: str) -> str:
-    max_tokens = 8192
-    """Intelligent truncation preserving code structure"""
-    lines = code.split('\n')
-    sections = []
-    current_section = []
-
-    # Group code into logical sections based on regex pattern
-    for line in lines:
-        if re.match(section_regex, line.lstrip()):
-            if current_section:
-                sections.append(current_section)
-            current_section = [line]
-        else:
-            current_section.append(line)
-    if current_section:
-        sections.append(current_section)
-
-    # Check if truncation is needed
-    total_tokens = sum(len(' '.join(sec).split()) for sec in sections)
-    if total_tokens <= max_tokens:
-        return '\n'.join(['\n'.join(sec) for sec in sections])
-
-    # Truncate while preserving complete sections where possible
-    kept_sections = []
-    current_tokens = 0
-
-    for sec in sections:
-        sec_tokens = len(' '.join(sec).split())
-        if current_tokens + sec_tokens > max_tokens:
-            break
-        kept_sections.append(sec)
-        current_tokens += sec_tokens
-
-    # Try to include partial sections with remaining tokens
-    if current_tokens < max_tokens:
-        remaining = max_tokens - current_tokens
-        for line in sections[len(kept_sections)]:
-            line_tokens = len(line.split())
-            if remaining - line_tokens >= 0:
-                kept_sections.append([line])
-                remaining -= line_tokens
-            else:
-                break
+    """Load .gitignore patterns into a GitIgnoreSpec, reading the file in one call"""
+    try:
+        with open(os.path.join(repo_path, '.gitignore'), 'r') as f:
+            content = f.read()
+    except FileNotFoundError:
+        return None
+    # Text mode already translated line endings to '\n'
+    lines = [line.strip() for line in content.split('\n') if line.strip() and not line.startswith('#')] + ['.git/']
+    return GitIgnoreSpec.from_lines(lines)
+
+# Rough characters-per-token ratio used to budget prompts without tokenizing them
+CHARS_PER_TOKEN = 4
+
+def truncate_code(code: str, max_tokens: int = 8192) -> str:
+    """
+    Truncate code to the prompt budget at a line boundary.
 
-    return '\n'.join(['\n'.join(sec) for sec in kept_sections])
+    Keeps the longest run of whole leading lines that fits in max_tokens, approximating tokens
+    as CHARS_PER_TOKEN characters. Keeping whole sections and then the leading lines of the
+    section that overflows comes to exactly this, so the cut is found with a single rfind for
+    the last newline inside the budget rather than by grouping lines into sections.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(code) <= max_chars:
+        return code
+
+    # A newline right at max_chars still ends a line that fits
+    cut = code.rfind('\n', 0, max_chars + 1)
+    return code[:cut] if cut != -1 else ''
+
+# Common installation and setup files
+SETUP_FILES = frozenset({
+    'setup.py', 'setup.cfg', 'setup.sh', 'install.sh', 'requirements.txt',
+    'Pipfile', 'Pipfile.lock', 'package.json', 'package-lock.json',
+    'yarn.lock', 'composer.json', 'composer.lock', 'Gemfile', 'Gemfile.lock'
+})
+
+# Common virtual environment and dependency directories
+VENV_DIRS = frozenset({
+    'venv', '.venv', 'env', '.env', 'node_modules', 'vendor',
+    '__pycache__', '.pytest_cache', '.mypy_cache', '.ruff_cache'
+})
+
+# Common build and distribution directories
+BUILD_DIRS = frozenset({'dist', 'build'})
+
+# Dotfiles that are not editor or IDE files
+ALLOWED_DOTFILES = frozenset({'.gitignore', '.env.example'})
+
+# Matches a path with any component in VENV_DIRS or BUILD_DIRS. Walker paths use '/', so that
+# separator is accepted alongside os.sep.
+_PATH_SEPARATORS = re.escape('/' + (os.sep if os.sep != '/' else ''))
+IGNORED_COMPONENT_PATTERN = re.compile(
+    rf"(?:^|[{_PATH_SEPARATORS}])(?:{'|'.join(map(re.escape, sorted(VENV_DIRS | BUILD_DIRS)))})(?:[{_PATH_SEPARATORS}]|$)"
+)
 
 def should_ignore_file(file_path: str) -> bool:
     """
@@ -642,79 +1165,234 @@ def should_ignore_file(file_path: str) -> bool:
     Returns:
         bool: True if the file should be ignored, False otherwise
     """
-    # Common installation and setup files
-    setup_files = {
-        'setup.py', 'setup.cfg', 'setup.sh', 'install.sh', 'requirements.txt',
-        'Pipfile', 'Pipfile.lock', 'package.json', 'package-lock.json',
-        'yarn.lock', 'composer.json', 'composer.lock', 'Gemfile', 'Gemfile.lock'
-    }
-
-    # Common virtual environment and dependency directories
-    venv_dirs = {
-        'venv', '.venv', 'env', '.env', 'node_modules', 'vendor',
-        '__pycache__', '.pytest_cache', '.mypy_cache', '.ruff_cache'
-    }
-
-    # Get the filename and directory components
     filename = os.path.basename(file_path)
-    dir_parts = file_path.split(os.sep)
 
-    # Check if it's a setup file
-    if filename in setup_files:
+    # Check if it's a setup file, or a common IDE and editor file
+    if filename in SETUP_FILES or (filename.startswith('.') and filename not in ALLOWED_DOTFILES):
         return True
 
-    # Check if it's in a virtual environment or dependency directory
-    if any(venv_dir in dir_parts for venv_dir in venv_dirs):
-        return True
+    # Check if it's in a virtual environment, dependency, build or distribution directory
+    return IGNORED_COMPONENT_PATTERN.search(file_path) is not None
 
-    # Check for common build and distribution directories
-    if 'dist' in dir_parts or 'build' in dir_parts:
-        return True
+def gitignore_matcher(spec: GitIgnoreSpec):
+    """
+    Return a function testing whether a normalized, '/'-separated path is ignored by spec.
 
-    # Check for common IDE and editor files
-    if filename.startswith('.') and filename not in ['.gitignore', '.env.example']:
-        return True
+    pathspec tries each pattern in a Python loop. Without negated patterns a path is ignored
+    exactly when any pattern matches, so the pattern regexes are fused into one alternation and
+    matched in a single call. Specs with negations keep pathspec's ordered evaluation.
+    """
+    if any(pattern.include is False for pattern in spec.patterns):
+        return spec.match_file
 
-    return False
+    # pathspec gives every pattern the same named groups, which cannot repeat in one regex
+    regexes = [re.sub(r'\(\?P<\w+>', '(?:', pattern.regex.pattern) for pattern in spec.patterns if pattern.include]
+    if not regexes:
+        return lambda path: False
+    try:
+        union = re.compile('|'.join(f'(?:{regex})' for regex in regexes))
+    except re.error:
+        return spec.match_file
+    return lambda path: union.match(path) is not None
 
-def process_file(args):
-    repo_path, repo_file_path, changed_files, cache_path, cache, new_cache, config = args
-    file_path = os.path.join(repo_path, repo_file_path)
-    ext = os.path.splitext(file_path)[-1].lower()
-    lang = next((k for k, v in config.items() if ext in v['extensions']), None)
+def iter_repository_files(repo_path: str, spec: Optional[GitIgnoreSpec], extensions: Optional[frozenset] = None):
+    """
+    Yield the repository-relative paths of all files not excluded by .gitignore.
 
-    try:
-        with open(file_path, 'r') as f:
-            original_code = f.read()
+    Directories are read with os.scandir, whose entries already carry the file type, and
+    dependency or build directories are pruned by name before they are descended into.
+    Paths use '/' separators, as expected by the gitignore matcher.
+
+    Args:
+        repo_path (str): Root of the repository.
+        spec (GitIgnoreSpec): Compiled .gitignore patterns, or None.
+        extensions (frozenset): Lowercase extensions to yield, or None for all files. Other
+            files are dropped by name before they are matched against .gitignore.
 
-        section_regex = config[lang]['section_regex']
-        truncated_code = truncate_code(original_code, section_regex)
+    Yields:
+        str: Path of each remaining file relative to repo_path.
+    """
+    # Without negated patterns a directory is ignored exactly when its path with a trailing
+    # slash matches, so one lookup suffices; negations need the bare path checked as well
+    has_negations = spec is not None and any(pattern.include is False for pattern in spec.patterns)
+    ignored = gitignore_matcher(spec) if spec else None
+
+    def dir_ignored(rel_path):
+        return ignored(f"{rel_path}/") or (has_negations and ignored(rel_path))
+
+    def walk(dir_path, rel_dir):
+        # Like os.walk, skip directories that cannot be read or vanished instead of failing the run
+        try:
+            entries = os.scandir(dir_path)
+        except OSError as e:
+            logger.warning("Skipping unreadable directory %s: %s", dir_path, e)
+            return
+        with entries:
+            for entry in entries:
+                rel_path = rel_dir + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name in VENV_DIRS or entry.name in BUILD_DIRS:
+                        continue
+                    if spec and dir_ignored(rel_path):
+                        continue
+                    yield from walk(entry.path, f"{rel_path}/")
+                elif entry.is_file():
+                    if extensions is not None and os.path.splitext(entry.name)[-1].lower() not in extensions:
+                        continue
+                    if spec and ignored(rel_path):
+                        continue
+                    yield rel_path
+
+    yield from walk(repo_path, '')
+
+def read_truncated_code(file_path: str, max_tokens: int = 8192) -> str:
+    """
+    Read a source file and truncate it to the documentation prompt budget.
+
+    truncate_code never keeps more than max_tokens * CHARS_PER_TOKEN characters, and one more
+    is enough for it to see that the file is over budget, so the rest of a large file is not read.
+    """
+    with open(file_path, 'r') as f:
+        original_code = f.read(max_tokens * CHARS_PER_TOKEN + 1)
+
+    return truncate_code(original_code, max_tokens)
+
+def batch_generate_documentation(repo_path: str, changed_files: List[str],
+                                 bucket: str, role_arn: str) -> Dict[str, str]:
+    """
+    Generate documentation for all changed files with one Bedrock batch inference job.
+
+    Returns a mapping of repository-relative path to the raw documentation and summary response.
+    Files that could not be read, or that the job did not complete, are left out so the caller
+    documents them synchronously.
+    """
+    prompts = {}
+    for repo_file_path in changed_files:
+        file_path = os.path.join(repo_path, repo_file_path)
+        try:
+            prompts[repo_file_path] = make_doc_and_summary_prompt(read_truncated_code(file_path), file_path)
+        except Exception as e:
+            logger.error("Error reading %s: %s", file_path, e)
+
+    if len(prompts) < BATCH_MIN_RECORDS:
+        return {}
+
+    try:
+        return bedrock_batch_generate(prompts, bucket, role_arn)
     except Exception as e:
-        tqdm.write(f"Error reading {file_path}: {str(e)}")
-        traceback.print_exc()
-        return (False, None, None, None, None)
+        logger.exception("Batch documentation failed, falling back to per-file requests: %s", e)
+        return {}
+
+# Share of the prompt budget the code of a group of files may use, leaving room for the output
+GROUP_BUDGET_RATIO = 0.6
+
+# Output tokens reserved for each file in a group, for its documentation, summary and JSON escaping
+GROUP_MIN_OUTPUT_TOKENS = 512
+
+def group_generate_documentation(repo_path: str, changed_files: List[str], group_size: int,
+                                 max_workers: int = 8, max_tokens: int = 8192,
+                                 model_id: str = 'anthropic.claude-3-sonnet-20240229-v1:0') -> Dict[str, str]:
+    """
+    Document small changed files several to a Bedrock request.
+
+    Files are packed in order into groups of at most group_size whose combined truncated code
+    fits in GROUP_BUDGET_RATIO of the prompt budget, and whose expected output fits in the one
+    response the group shares, limited by the model's output token limit. Each file is expected
+    to need the larger of GROUP_MIN_OUTPUT_TOKENS and its code's token estimate. Groups are
+    requested concurrently with the full output budget.
+
+    Returns a mapping of repository-relative path to a per-file documentation and summary
+    response, like batch_generate_documentation. Files too large to share a request with at least
+    one other, that could not be read, or that a response left out are not included, so the
+    caller documents them on their own.
+    """
+    budget = int(max_tokens * CHARS_PER_TOKEN * GROUP_BUDGET_RATIO)
+    output_budget = MODEL_MAX_TOKENS.get(model_id, DEFAULT_MODEL_MAX_TOKENS)
+    groups = []
+    group = []
+    group_chars = 0
+    group_output = 0
+    for repo_file_path in changed_files:
+        file_path = os.path.join(repo_path, repo_file_path)
+        try:
+            code = read_truncated_code(file_path, max_tokens)
+        except Exception as e:
+            logger.error("Error reading %s: %s", file_path, e)
+            continue
+        output = max(GROUP_MIN_OUTPUT_TOKENS, len(code) // CHARS_PER_TOKEN)
+        if len(code) > budget or output * 2 > output_budget:
+            continue
+
+        if group and (len(group) == group_size or group_chars + len(code) > budget
+                      or group_output + output > output_budget):
+            groups.append(group)
+            group = []
+            group_chars = 0
+            group_output = 0
+        group.append((repo_file_path, code))
+        group_chars += len(code)
+        group_output += output
+    if group:
+        groups.append(group)
+
+    # A group of one is no cheaper than the per-file prompt
+    groups = [group for group in groups if len(group) > 1]
+    if not groups:
+        return {}
+
+    def document_group(group):
+        response = bedrock_generate(make_grouped_doc_and_summary_prompt(group), model_id=model_id, max_tokens=output_budget)
+        return parse_grouped_doc_and_summary(response, [path for path, _ in group])
+
+    logger.info("Documenting %d small files in %d grouped requests...", sum(len(group) for group in groups), len(groups))
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in as_completed([executor.submit(document_group, group) for group in groups]):
+            try:
+                results.update(future.result())
+            except Exception as e:
+                logger.exception("Grouped documentation failed, falling back to per-file requests: %s", e)
+    return results
+
+def documentation_path(repo_path: str, file_path: str) -> str:
+    """Path of the generated documentation for a source file, in the files subdirectory"""
+    files_dir = os.path.join(repo_path, 'wraith.docs', 'files')
+    os.makedirs(files_dir, exist_ok=True)
+    return os.path.join(files_dir, f"{os.path.basename(file_path)}.docs.md")
+
+def write_documentation(doc_path: str, lang: str, doc: str):
+    """Write a file's generated documentation under its language heading"""
+    with open(doc_path, 'w') as f:
+        f.write(f"# {lang.capitalize()} Code Documentation\n")
+        f.write(doc)
+
+def process_file(args):
+    repo_path, repo_file_path, changed_files, cache_path, cache, new_cache, config, prebuilt_docs, ext_langs = args
+    file_path = os.path.join(repo_path, repo_file_path)
+    lang = ext_langs.get(os.path.splitext(file_path)[-1].lower())
 
     summary = ""
     doc = ""
-    # Store individual file documentation in the files subdirectory
-    docs_dir = os.path.join(repo_path, 'wraith.docs')
-    files_dir = os.path.join(docs_dir, 'files')
-    os.makedirs(files_dir, exist_ok=True)
-    doc_path = os.path.join(files_dir, f"{os.path.basename(file_path)}.docs.md")
+    doc_path = documentation_path(repo_path, file_path)
 
     if repo_file_path in changed_files:
+        # Only changed files need their code; unchanged ones reuse the stored documentation
         try:
-            tqdm.write(f"{repo_file_path} ({lang}) has changed, processing...")
-            doc = generate_documentation(truncated_code, file_path)
-
-            with open(doc_path, 'w') as f:
-                f.write(f"# {lang.capitalize()} Code Documentation\n")
-                f.write(doc)
+            truncated_code = read_truncated_code(file_path)
+        except Exception as e:
+            logger.exception("Error reading %s: %s", file_path, e)
+            return (False, None, None, None, None)
 
-            summary = generate_summary(doc, file_path)
+        try:
+            logger.debug("%s (%s) has changed, processing...", repo_file_path, lang)
+            doc, summary = generate_doc_and_summary(truncated_code, file_path, prebuilt_docs.get(repo_file_path))
+            # Bedrock failures come back empty; failing the file keeps its hash out of the cache
+            # so it is documented again on the next run
+            if not doc:
+                raise ValueError("Empty documentation response")
+            write_documentation(doc_path, lang, doc)
         except Exception as e:
-            tqdm.write(f"Error generating documentation for {file_path}: {str(e)}")
-            traceback.print_exc()
+            logger.exception("Error generating documentation for %s: %s", file_path, e)
             return (False, None, None, None, None)
     else:
         try:
@@ -723,13 +1401,44 @@ def process_file(args):
                     doc = f.read()
                 summary = cache['summaries'][repo_file_path]
         except Exception as e:
-            tqdm.write(f"Error reading existing documentation for {file_path}: {str(e)}")
-            traceback.print_exc()
+            logger.exception("Error reading existing documentation for %s: %s", file_path, e)
             return (False, None, None, None, None)
     return (True, repo_file_path, file_path, summary, doc)
 
-def process_repository(repo_path: str, config: Dict):
-    """Process all code files in the repository while respecting .gitignore"""
+def default_max_workers() -> int:
+    """
+    Number of files documented concurrently unless configured: enough workers to fill every
+    Bedrock slot, plus ThreadPoolExecutor's usual allowance for I/O, so files that only need their
+    stored documentation read are not queued behind workers waiting on Bedrock.
+    """
+    return bedrock_limit + min(32, (os.cpu_count() or 1) + 4)
+
+def process_repository(repo_path: str, config: Dict, max_workers: Optional[int] = None,
+                       batch_bucket: Optional[str] = None, batch_role_arn: Optional[str] = None,
+                       use_response_cache: bool = True, group_size: int = 1,
+                       hash_algorithm: str = DEFAULT_HASH_ALGORITHM):
+    """Process all code files in the repository while respecting .gitignore.
+
+    Files are documented concurrently by max_workers threads, default_max_workers() if None.
+    Workers documenting changed files spend most of their time waiting on Bedrock, whose
+    in-flight requests are limited separately, so this scales with the account's request quota
+    rather than CPU.
+
+    When batch_bucket and batch_role_arn are given and enough files have changed, the
+    documentation prompts are first run as a single Bedrock batch inference job.
+
+    Unless use_response_cache is False, Bedrock responses are cached under wraith.docs so
+    re-runs over identical content do not call Bedrock again. Responses unused for
+    RESPONSE_CACHE_MAX_AGE are removed once the run completes.
+
+    When group_size is greater than 1, small changed files not covered by a batch job are
+    documented up to group_size at a time in a single Bedrock request.
+
+    hash_algorithm selects the hash used to detect changed and duplicate files.
+    """
+    global response_cache_dir
+    if max_workers is None:
+        max_workers = default_max_workers()
     summaries = []
     doc_contents = []  # Store full documentation content
     spec = get_gitignore_spec(repo_path)
@@ -740,86 +1449,104 @@ def process_repository(repo_path: str, config: Dict):
     os.makedirs(docs_dir, exist_ok=True)
     os.makedirs(files_dir, exist_ok=True)
 
+    if use_response_cache:
+        response_cache_dir = os.path.join(docs_dir, '.wraith.responses')
+        os.makedirs(response_cache_dir, exist_ok=True)
+    else:
+        response_cache_dir = None
+
     # Filter out ignored files
+    ext_langs = extension_languages(config)
     filtered_files = []
-    for root, dirs, files in os.walk(repo_path, topdown=True):
-        rel_dir = os.path.relpath(root, repo_path).replace('\\', '/')
-        if spec:
-            dir_ignored = spec.match_file(rel_dir) or spec.match_file(f"{rel_dir}/")
-            if dir_ignored:
-                dirs[:] = []
-                continue
-
-        for file in files:
-            file_path = os.path.join(root, file)
-            rel_path = os.path.relpath(file_path, repo_path).replace('\\', '/')
-
-            if spec and spec.match_file(rel_path):
-                continue
-
-            if should_ignore_file(rel_path):
-                continue
-
-            ext = os.path.splitext(file_path)[-1].lower()
-            lang = next((k for k, v in config.items() if ext in v['extensions']), None)
-            if lang:
-                filtered_files.append(os.path.relpath(os.path.abspath(os.path.join(root, file)), os.path.abspath(repo_path)))
+    for rel_path in iter_repository_files(repo_path, spec, frozenset(ext_langs)):
+        if not should_ignore_file(rel_path):
+            filtered_files.append(rel_path)
 
     cache_path = os.path.join(docs_dir, '.wraith.cache.json')
-    changed_files, new_cache = compute_cache(repo_path, filtered_files, cache_path)
-
-    try:
-        with open(cache_path, 'r') as f:
-            cache = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        cache = {'hashes': {}, 'summaries': {}}
-
-    if 'hashes' not in cache:
-        cache['hashes'] = {}
-    if 'summaries' not in cache:
-        cache['summaries'] = {}
-
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures = [executor.submit(process_file, (repo_path, repo_file_path, changed_files, cache_path, cache, new_cache, config)) for repo_file_path in filtered_files]
-        with tqdm(total=len(futures), miniters=1, mininterval=0.1, colour='green', position=0, desc="Generating documentation") as pbar:
+    cache = load_cache(cache_path)
+    stored_summaries = dict(cache['summaries'])
+    changed_files, new_cache = compute_cache(repo_path, filtered_files, cache_path, algorithm=hash_algorithm,
+                                             stored_cache=cache)
+
+    # Changed files with identical content are documented once, through the first copy found
+    duplicates = {}
+    first_copy = {}
+    for repo_file_path in changed_files:
+        content_hash = new_cache['hashes'][repo_file_path]
+        if content_hash in first_copy:
+            duplicates.setdefault(first_copy[content_hash], []).append(repo_file_path)
+        else:
+            first_copy[content_hash] = repo_file_path
+    duplicate_files = {path for paths in duplicates.values() for path in paths}
+    changed_files = [path for path in changed_files if path not in duplicate_files]
+
+    prebuilt_docs = {}
+    if batch_bucket and batch_role_arn and len(changed_files) >= BATCH_MIN_RECORDS:
+        prebuilt_docs = batch_generate_documentation(repo_path, changed_files, batch_bucket, batch_role_arn)
+    if group_size > 1:
+        ungrouped = [path for path in changed_files if path not in prebuilt_docs]
+        prebuilt_docs.update(group_generate_documentation(repo_path, ungrouped, group_size, max_workers))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        changed_set = frozenset(changed_files)
+        futures = [executor.submit(process_file, (repo_path, repo_file_path, changed_set, cache_path, cache, new_cache, config, prebuilt_docs, ext_langs)) for repo_file_path in filtered_files if repo_file_path not in duplicate_files]
+        with tqdm(total=len(filtered_files), miniters=1, mininterval=0.1, colour='green', position=0, desc="Generating documentation") as pbar:
             for future in as_completed(futures):
                 success, repo_file_path, file_path, summary, doc = future.result()
-                pbar.update(1)
+                pbar.update(1 + len(duplicates.get(repo_file_path, [])))
                 if not success:
                     continue
 
-
-                #only update hashes if we succeeded
-                doc_contents.append((repo_file_path, file_path, doc))
-                cache['hashes'][repo_file_path] = new_cache['hashes'][repo_file_path]
-
-                if summary:
-                    summaries.append((file_path, summary))
-                    cache['summaries'][repo_file_path] = summary
+                documented = [(repo_file_path, file_path)]
+                for duplicate_path in duplicates.get(repo_file_path, []):
+                    duplicate_file_path = os.path.join(repo_path, duplicate_path)
+                    lang = ext_langs[os.path.splitext(duplicate_path)[-1].lower()]
+                    try:
+                        write_documentation(documentation_path(repo_path, duplicate_file_path), lang, doc)
+                        documented.append((duplicate_path, duplicate_file_path))
+                    except Exception as e:
+                        logger.exception("Error writing documentation for %s: %s", duplicate_file_path, e)
+
+                for repo_file_path, file_path in documented:
+                    #only update hashes if we succeeded
+                    doc_contents.append((repo_file_path, file_path, doc))
+                    cache['hashes'][repo_file_path] = new_cache['hashes'][repo_file_path]
+                    cache['stats'][repo_file_path] = new_cache['stats'][repo_file_path]
+
+                    if summary:
+                        summaries.append((file_path, summary))
+                        cache['summaries'][repo_file_path] = summary
 
     for path in list(cache['hashes'].keys()):
         if path not in new_cache['hashes']:
             del cache['hashes'][path]
             if path in cache['summaries']:
                 del cache['summaries'][path]
+    for path in list(cache['stats'].keys()):
+        if path not in cache['hashes']:
+            del cache['stats'][path]
 
-    with open(cache_path, 'w') as f:
-        json.dump(cache, f, indent=4)
+    cache['algorithm'] = new_cache['algorithm']
+    save_cache(cache_path, cache, stored_summaries)
 
     try:
         summary_path = os.path.join(docs_dir, 'summary.docs.md')
+        # Every path is os.path.join(repo_path, relative path), so the prefix is sliced off rather
+        # than normalizing both paths with os.path.relpath for each summary
+        prefix_length = len(os.path.join(repo_path, ''))
+        sections = "".join(
+            f"## {path[prefix_length:].replace(os.sep, '/')}\n\n{summary}\n\n"
+            for path, summary in summaries
+        )
         with open(summary_path, 'w') as f:
-            f.write("# Repository Overview\n\n")
-            for path, summary in summaries:
-                rel_path = os.path.relpath(path, repo_path).replace('\\', '/')
-                f.write(f"## {rel_path}\n\n{summary}\n\n")
+            f.write("# Repository Overview\n\n" + sections)
     except Exception as e:
-        tqdm.write(f"Error creating summary: {str(e)}")
+        logger.error("Error creating summary: %s", e)
 
     # Generate data flow diagram
     diagram_path = os.path.join(docs_dir, 'system-dataflow.md')
     try:
-        tqdm.write(f"Documentation generated, generating threat model diagram...")
+        logger.info("Documentation generated, generating threat model diagram...")
         # Generate the diagram using the comprehensive documentation
         diagram = generate_threat_model_diagram(summaries)
 
@@ -828,20 +1555,38 @@ def process_repository(repo_path: str, config: Dict):
             f.write(diagram)
 
     except Exception as e:
-        tqdm.write(f"Error creating data flow diagram: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error creating data flow diagram: %s", e)
+
+    prune_response_cache()
 
     return doc_contents
 
 def main():
+    global latency_optimized_inference
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Repository Code Processor')
     parser.add_argument('repo_path', type=str, nargs='?', default='', help='Path to the repository')
     parser.add_argument('--config-file', type=str)
     parser.add_argument('--enable-languages', type=str)
     parser.add_argument('--disable-languages', type=str)
+    parser.add_argument('--max-workers', type=int, help='Number of files to document concurrently (default: Bedrock concurrency plus an I/O allowance)')
+    parser.add_argument('--bedrock-concurrency', type=int, default=BEDROCK_CONCURRENCY, help='Maximum number of Bedrock requests in flight at once')
+    parser.add_argument('--batch-bucket', type=str, help='S3 bucket for Bedrock batch inference on large runs')
+    parser.add_argument('--batch-role-arn', type=str, help='IAM role Bedrock assumes for batch inference')
+    parser.add_argument('--group-size', type=int, default=1, help='Number of small files to document per Bedrock request')
+    parser.add_argument('--standard-latency', action='store_true', help='Do not request latency-optimized Bedrock inference')
+    parser.add_argument('--hash-algorithm', type=str, default=DEFAULT_HASH_ALGORITHM, help='Hash used to detect changed files, e.g. sha256')
+    parser.add_argument('--no-cache', action='store_true', help='Always call Bedrock instead of reusing cached responses')
+    parser.add_argument('--verbose', action='store_true', help='Log per-file progress and debugging detail')
     args = parser.parse_args()
 
+    handler = TqdmLoggingHandler()
+    handler.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, handlers=[handler])
+    # Keep AWS SDK chatter out of --verbose output
+    logging.getLogger('botocore').setLevel(logging.WARNING)
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
+
     # Load custom configuration if provided
     config = {}
     if args.config_file:
@@ -851,7 +1596,7 @@ def main():
                 config = json.loads(content) if content else {}
                 config = config or {}  # Fallback to empty dict if loaded value is false
         except Exception as e:
-            tqdm.write(f"Error loading config file: {e}")
+            logger.error("Error loading config file: %s", e)
             return
 
     # Set up language processing configuration
@@ -859,19 +1604,29 @@ def main():
     disable_langs = args.disable_languages.split(',') if args.disable_languages else config.get('disable_languages', [])
 
     language_config = get_language_config(enable_langs, disable_langs)
+    set_bedrock_concurrency(args.bedrock_concurrency)
+    latency_optimized_inference = not args.standard_latency
 
     if args.repo_path:
         # Process the repository
         try:
             result = process_repository(
                 args.repo_path,
-                language_config
+                language_config,
+                max_workers=args.max_workers,
+                batch_bucket=args.batch_bucket,
+                batch_role_arn=args.batch_role_arn,
+                use_response_cache=not args.no_cache,
+                group_size=args.group_size,
+                hash_algorithm=args.hash_algorithm
             )
         except Exception as e:
-            tqdm.write(f"Processing failed: {e}")
-            traceback.print_exc()
+            logger.exception("Processing failed: %s", e)
     else:
-        # Boot the HTTP server if we're not trying to process a specific repo
+        # Boot the HTTP server if we're not trying to process a specific repo. The API imports
+        # process_repository from main on its first scan; point that at this already loaded module
+        # so the first request neither re-imports the whole pipeline nor loses the settings above.
+        sys.modules.setdefault('main', sys.modules[__name__])
         bottle.run(host='0.0.0.0', port=3000, debug=True, reloader=True)
 
 
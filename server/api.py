@@ -5,26 +5,22 @@ import hashlib
 import tempfile
 import os
 import random
+import functools
 
 random.seed(0)
 tmp_dir = tempfile.mkdtemp()
-def string_to_sha256(input_string):
-    # Create a sha256 hash object
-    sha256_hash = hashlib.sha256()
-
-    # Update the hash object with the bytes of the input string
-    sha256_hash.update(input_string.encode('utf-8'))
-
-    # Return the hexadecimal representation of the hash
-    return sha256_hash.hexdigest()
+def string_to_digest(input_string):
+    # Only needs to tell repository URLs apart, so a 128-bit BLAKE2b digest is plenty
+    return hashlib.blake2b(input_string.encode('utf-8'), digest_size=16).hexdigest()
 
 @route('/api')
 def healthCheck():
   response.content_type = 'text/text; charset=UTF8'
   return "Wraith API Healthy"
 
+@functools.lru_cache(maxsize=1024)
 def get_clone_dir(repo_url):
-    return os.path.join(tmp_dir, string_to_sha256(repo_url))
+    return os.path.join(tmp_dir, string_to_digest(repo_url))
 
 @get('/api/scan')
 @post('/api/scan')
@@ -35,16 +31,27 @@ def scan():
     response.status = 400
     return { 'status': response.status, 'message': 'Bad Request - parameter repo_url is required.' }
 
+  from main import process_repository, get_language_config
+
+  # Optionally restrict the scan to a list, or comma separated string, of languages
+  languages = request.query.get('languages') or (request.json or {}).get('languages')
+  if isinstance(languages, str):
+    languages = languages.split(',')
+  elif languages and not (isinstance(languages, list) and all(isinstance(lang, str) for lang in languages)):
+    response.status = 400
+    return { 'status': response.status, 'message': 'Bad Request - parameter languages must be a list or comma separated string.' }
+  config = get_language_config(languages or None)
+  extensions = [ext for cfg in config.values() for ext in cfg['extensions']] if languages else None
+
   clone_dir = get_clone_dir(repo_url)
 
   # Attempt to retrieve files from github URL
-  get_repo(repo_url, clone_dir)
+  get_repo(repo_url, clone_dir, extensions)
 
-  from main import process_repository, LANGUAGE_CONFIG
   try:
     result = process_repository(
       repo_path=clone_dir,
-      config=LANGUAGE_CONFIG
+      config=config
     )
     if not result:
       response.status = 500
@@ -57,6 +64,14 @@ def scan():
     print(e)
     return e
 
+DIAGRAM_TEMPLATE = './server/diagram.html'
+
+@functools.lru_cache(maxsize=1)
+def diagram_template_parts(mtime_ns):
+    # The template split around its placeholder, re-read only when the file's mtime changes
+    with open(DIAGRAM_TEMPLATE, 'r') as f:
+        return f.read().split('%mermaidStr%')
+
 @get('/diagram')
 def renderDiagram():
     if 'repo_url' in request.query:
@@ -70,10 +85,9 @@ def renderDiagram():
     try:
         with open(os.path.join(get_clone_dir(repo_url), 'wraith.docs/system-dataflow.md'), 'r') as f:
             mermaidStr = f.read()
-        with open('./server/diagram.html', 'r') as f:
-            html = f.read()
+        parts = diagram_template_parts(os.stat(DIAGRAM_TEMPLATE).st_mtime_ns)
 
-        return html.replace('%mermaidStr%', mermaidStr)
+        return mermaidStr.join(parts)
     except Exception as e:
         response.status = 500
         print(e)